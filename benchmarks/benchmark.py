@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+""" Benchmark of all phases of playlistcopy with a synthetic library
+
+A library of tagged MP3 stubs and several M3U/M3U8 playlists (with tracks on
+several playlists and non UTF-8 encodings) are generated on tmpfs. Every phase
+of sync, reshuffle and stats and every tag reader is timed separately, the
+results are printed as JSON.
+
+    python3 benchmarks/benchmark.py --scales 1000,10000 --output results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import playlistcopy  # noqa: E402
+
+ARTISTS = ['Artist %d' % i for i in range(200)] + ['Mötley Crüe', 'Björk', 'Sigur Rós', 'Motörhead']
+MPEG_FRAME = b'\xff\xfb\x90\x00' + b'\x00' * 413  # MPEG 1 Layer III, 128 kbit/s, 44.1 kHz
+
+
+def _id3_frame(frame_id, text):
+    """ ID3v2.3 text frame (UTF-16 with BOM)
+    """
+    data = b'\x01' + text.encode('utf-16')
+    return frame_id.encode('ascii') + struct.pack('>I', len(data)) + b'\x00\x00' + data
+
+
+def _synchsafe(value):
+    """ Synchsafe integer of ID3v2 headers
+    """
+    return bytes([(value >> 21) & 0x7f, (value >> 14) & 0x7f, (value >> 7) & 0x7f, value & 0x7f])
+
+
+def write_mp3_stub(path, artist, album, title, genre='Rock', year='1999', frames=4):
+    """ Write a small MP3 file with ID3v2 tags
+    """
+    body = (_id3_frame('TPE1', artist) + _id3_frame('TALB', album) + _id3_frame('TIT2', title) +
+            _id3_frame('TCON', genre) + _id3_frame('TYER', year))
+    with open(path, 'wb') as f:
+        f.write(b'ID3\x03\x00\x00' + _synchsafe(len(body)) + body + MPEG_FRAME * frames)
+
+
+def generate_library(root, track_count, seed=0):
+    """ Generate library with track_count tracks and playlists
+
+    Returns two lists of playlists: the old ones (synced before) and the current ones
+    (about 10 % of the tracks were removed and 10 % were added in comparison).
+    """
+    rnd = random.Random(seed)
+    tracks = []
+    for k in range(track_count):
+        artist = rnd.choice(ARTISTS)
+        album = 'Album %d' % rnd.randrange(track_count // 10 + 1)
+        folder = os.path.join(root, 'library', artist, album)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, '%04d track.mp3' % k)
+        title = 'Title %d' % rnd.randrange(track_count)  # Some equal names, become "(2)" etc.
+        write_mp3_stub(path, artist, album, title)
+        tracks.append(os.path.relpath(path, root))
+
+    old_tracks = tracks[:track_count * 9 // 10]
+    new_tracks = tracks[track_count // 10:]
+    return (_write_playlists(root, 'old', old_tracks, rnd), _write_playlists(root, 'new', new_tracks, rnd))
+
+
+def _write_playlists(root, prefix, tracks, rnd):
+    """ Write tracks to three playlists: M3U (Latin-1), M3U8 and M3U (UTF-8), a quarter of
+    the tracks is on two playlists
+    """
+    third = len(tracks) // 3
+    parts = [tracks[:third], tracks[third:2 * third], tracks[2 * third:]]
+    parts[1] = parts[1] + rnd.sample(parts[0], len(parts[0]) // 4)
+    playlists = []
+    for k, (ext, encoding) in enumerate((('m3u', 'latin-1'), ('m3u8', 'utf-8'), ('m3u', 'utf-8'))):
+        path = os.path.join(root, '%s-%d.%s' % (prefix, k, ext))
+        lines = ['#EXTM3U'] + ['#EXTINF:-1,%s' % os.path.basename(t) + '\n' + t for t in parts[k]]
+        with open(path, 'w', encoding=encoding, errors='replace') as f:
+            f.write('\n'.join(lines) + '\n')
+        playlists.append(path)
+    return playlists
+
+
+class Benchmark:
+    """ Time phases of playlistcopy
+    """
+    def __init__(self, root, track_count, tracks_per_folder=255):
+        self.root = root
+        self.track_count = track_count
+        self.tracks_per_folder = tracks_per_folder
+        self.results = {}
+
+    def _time(self, phase, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.results[phase] = round(time.perf_counter() - start, 6)
+        return result
+
+    def run(self):
+        """ Generate library, sync old playlists (not timed) and time all phases of a sync of new playlists
+        """
+        old_playlists, new_playlists = self._time('generate_library', generate_library, self.root,
+                                                  self.track_count)
+        self._read_tags()
+        destination = os.path.join(self.root, 'destination')
+        os.mkdir(destination)
+        tag_cache = os.path.join(self.root, 'tags.sqlite')
+        self._time('setup_sync', self._new_instance(destination, old_playlists, tag_cache).run)
+
+        self.results['plan_memory_peak'], self.results['plan_memory_retained'] = self._plan_memory(
+            destination, new_playlists, tag_cache)
+
+        plc = self._new_instance(destination, new_playlists)
+        self._time('parse_playlist', lambda: [plc._parse_playlist(p) for p in plc.playlists])
+        self._time('build_rewritten_filenames', plc._build_rewritten_filenames)
+        self._time('build_rewritten_filenames_cached', self._build_rewritten_filenames_cached,
+                   destination, new_playlists, plc.tracks, tag_cache)
+        self._time('build_destination_file_list', plc._build_destination_file_list)
+        additions, deletions, updates = self._time('compare', plc._compare)
+        self._time('plan_deletions', plc._sync_deletions, deletions)
+        self._time('plan_additions', plc._sync_additions, additions)
+        # Allocation of folders within plan_additions (timed by the phase of PlaylistCopy)
+        self.results['prepare_copying_additions'] = round(plc.metrics.phases['prepare_copying_additions']['wall'], 6)
+        journal = playlistcopy.Journal(os.path.join(destination, playlistcopy.JOURNAL_NAME))
+        self._time('write_journal', journal.create, plc.actions)
+        self._time('apply', plc._apply_actions, [(plc, journal, plc.actions, 0)])
+        self._time('write_manifest', plc._write_manifest)
+
+        self._time('build_destination_file_list_manifest', self._new_instance(
+            destination, new_playlists)._build_destination_file_list)
+        self._time('reshuffle', playlistcopy.PlaylistCopyReshuffle(destination).run)
+        self._time('stats', self._stats, destination)
+        self.results['additions'] = len(additions)
+        self.results['deletions'] = len(deletions)
+        return self.results
+
+    def _read_tags(self):
+        """ Time all tag readers (without tag cache) on all tracks of library
+        """
+        tracks = [os.path.join(path, f) for path, _, files in os.walk(os.path.join(self.root, 'library'))
+                  for f in files]
+        for reader in playlistcopy.TAG_READERS:
+            if reader == 'hsaudiotag' and playlistcopy.optional_module('hsaudiotag.auto') is None:
+                continue
+            self._time('read_tags_' + reader, playlistcopy.read_tags_many, tracks, 1, None, None, reader)
+        if 'read_tags_hsaudiotag' in self.results:
+            self.results['read_tags_speedup'] = round(self.results['read_tags_hsaudiotag']
+                                                      / self.results['read_tags_native'], 2)
+
+    def _plan_memory(self, destination, playlists, tag_cache):
+        """ Peak of memory allocated while planning a sync (dry run, warm tag cache) and memory
+        still used by the plan afterwards, in bytes
+        """
+        plc = self._new_instance(destination, playlists, tag_cache)
+        plc.dry_run = True
+        tracemalloc.start()
+        try:
+            plc.run()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return peak, current
+
+    def _new_instance(self, destination, playlists, tag_cache=None):
+        return playlistcopy.PlaylistCopy(destination, playlists, tracks_per_folder=self.tracks_per_folder,
+                                         tag_cache=tag_cache)
+
+    def _build_rewritten_filenames_cached(self, destination, playlists, tracks, tag_cache):
+        plc = self._new_instance(destination, playlists)
+        plc.tracks = list(tracks)
+        plc.tag_cache = playlistcopy.TagCache(tag_cache)
+        try:
+            plc._build_rewritten_filenames()
+        finally:
+            plc.tag_cache.close()
+
+    @staticmethod
+    def _stats(destination):
+        plcs = playlistcopy.PlaylistCopyStats(destination)
+        plcs._get_tracks()
+        plcs.get_groups()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark phases of playlistcopy with a synthetic library')
+    parser.add_argument('--scales', default='1000,10000',
+                        help='comma separated track counts (default: %(default)s)')
+    parser.add_argument('--tmp', default='/dev/shm' if os.path.isdir('/dev/shm') else None,
+                        help='directory for the library, should be tmpfs (default: %(default)s)')
+    parser.add_argument('--tracks-per-folder', default=255, type=int,
+                        help='tracks per folder in destination (default %(default)s)')
+    parser.add_argument('--output', '-o', help='write JSON to file instead of stdout')
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scales': {},
+    }
+    for scale in (int(s) for s in args.scales.split(',')):
+        root = tempfile.mkdtemp(prefix='playlistcopy-benchmark-', dir=args.tmp)
+        try:
+            results['scales'][str(scale)] = Benchmark(root, scale, args.tracks_per_folder).run()
+        finally:
+            shutil.rmtree(root)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,1221 @@
 #!/usr/bin/env python3
 
 import argparse
+import codecs
 import collections
+import concurrent.futures
+import contextlib
+import errno
+import functools
+import hashlib
+import heapq
+import importlib
+import itertools
+import json
 import logging
+import mmap
 import os
 import random
 import re
-import shutil
+import select
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+# Heavy and optional modules (chardet, hsaudiotag, sqlite3, urllib.request, ...) are imported
+# on first use, so planning and --version start fast
+
+
+INTERNAL_PREFIX = '.playlistcopy'  # Files in destination with this prefix are ignored
+MANIFEST_NAME = '.playlistcopy-manifest'
+MANIFEST_VERSION = 1
+MANIFEST_RACY_NS = 2 * 10**9  # Directory mtime granularity (FAT: 2 seconds)
+MANIFEST_SAMPLE = 3  # Files of a directory checked for existence before its listing of the manifest is used
+JOURNAL_NAME = '.playlistcopy-journal'
+JOURNAL_VERSION = 1
+JOURNAL_CHECKPOINT_BYTES = 256 * 1024 * 1024  # Flush and checkpoint after copying this many bytes
+PART_SUFFIX = '.part'  # Temporary files of copies (with INTERNAL_PREFIX)
+STAGING_NAME = '.playlistcopy-staging'  # Folder for temporary files of copies and rewriting order of entries
+HASH_CHUNK_SIZE = 1024 * 1024
+# inotify (linux/inotify.h)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+INOTIFY_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+                | IN_MOVE_SELF | IN_ONLYDIR)
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (name follows)
+COPY_BUFFER_SIZE = 1024 * 1024
+COPY_BACKENDS = ('auto', 'copy_file_range', 'sendfile', 'buffered')
+READ_ORDERS = ('playlist', 'inode', 'directory')  # Order of reading sources within a batch of copies
+ENTRY_ORDERS = ('append', 'rewrite')  # How directory entries of destination get their order
+# Errors of kernel copy calls which mean "not supported here" (fallback to next backend)
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF,
+                        errno.EPERM)
+
+# Byte order marks and their encoding (UTF-32 before UTF-16, same prefix)
+BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+
+TAG_HEADER_SIZE = 64 * 1024  # First read of native tag reader (whole ID3v2 tag only if needed)
+TAG_FIELDS = ('artist', 'album', 'title', 'genre', 'year')
+ID3_FIELDS = {b'TPE1': 'artist', b'TALB': 'album', b'TIT2': 'title', b'TCON': 'genre', b'TYER': 'year',
+              b'TDRC': 'year', b'TP1': 'artist', b'TAL': 'album', b'TT2': 'title', b'TCO': 'genre', b'TYE': 'year'}
+ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+ID3_GENRE_NUMBER = re.compile(r'^\((\d{1,3})\)|^(\d{1,3})$')  # '(17)', '(17)Rock' or '17'
+VORBIS_FIELDS = {b'ARTIST': 'artist', b'ALBUM': 'album', b'TITLE': 'title', b'GENRE': 'genre', b'DATE': 'year'}
+MP4_FIELDS = {b'\xa9ART': 'artist', b'\xa9alb': 'album', b'\xa9nam': 'title', b'\xa9gen': 'genre',
+              b'\xa9day': 'year', b'gnre': 'genre'}
+ID3_GENRES = (  # Genres of ID3v1 (with Winamp extensions), referenced by number
+    'Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk', 'Grunge', 'Hip-Hop', 'Jazz', 'Metal', 'New Age',
+    'Oldies', 'Other', 'Pop', 'R&B', 'Rap', 'Reggae', 'Rock', 'Techno', 'Industrial', 'Alternative', 'Ska',
+    'Death Metal', 'Pranks', 'Soundtrack', 'Euro-Techno', 'Ambient', 'Trip-Hop', 'Vocal', 'Jazz+Funk', 'Fusion',
+    'Trance', 'Classical', 'Instrumental', 'Acid', 'House', 'Game', 'Sound Clip', 'Gospel', 'Noise', 'AlternRock',
+    'Bass', 'Soul', 'Punk', 'Space', 'Meditative', 'Instrumental Pop', 'Instrumental Rock', 'Ethnic', 'Gothic',
+    'Darkwave', 'Techno-Industrial', 'Electronic', 'Pop-Folk', 'Eurodance', 'Dream', 'Southern Rock', 'Comedy',
+    'Cult', 'Gangsta', 'Top 40', 'Christian Rap', 'Pop/Funk', 'Jungle', 'Native American', 'Cabaret', 'New Wave',
+    'Psychadelic', 'Rave', 'Showtunes', 'Trailer', 'Lo-Fi', 'Tribal', 'Acid Punk', 'Acid Jazz', 'Polka', 'Retro',
+    'Musical', 'Rock & Roll', 'Hard Rock', 'Folk', 'Folk-Rock', 'National Folk', 'Swing', 'Fast Fusion', 'Bebob',
+    'Latin', 'Revival', 'Celtic', 'Bluegrass', 'Avantgarde', 'Gothic Rock', 'Progressive Rock', 'Psychedelic Rock',
+    'Symphonic Rock', 'Slow Rock', 'Big Band', 'Chorus', 'Easy Listening', 'Acoustic', 'Humour', 'Speech',
+    'Chanson', 'Opera', 'Chamber Music', 'Sonata', 'Symphony', 'Booty Bass', 'Primus', 'Porn Groove', 'Satire',
+    'Slow Jam', 'Club', 'Tango', 'Samba', 'Folklore', 'Ballad', 'Power Ballad', 'Rhythmic Soul', 'Freestyle',
+    'Duet', 'Punk Rock', 'Drum Solo', 'A capella', 'Euro-House', 'Dance Hall', 'Goa', 'Drum & Bass', 'Club-House',
+    'Hardcore', 'Terror', 'Indie', 'BritPop', 'Negerpunk', 'Polsk Punk', 'Beat', 'Christian', 'Heavy Metal',
+    'Black Metal', 'Crossover', 'Contemporary', 'Christian Rock', 'Merengue', 'Salsa', 'Thrash Metal', 'Anime',
+    'JPop', 'Synthpop')
+
+Tags = collections.namedtuple('Tags', 'valid artist album title genre year')
+
+
+def _tags(fields, valid=True):
+    """ Tags from dict of found fields (missing ones empty)
+    """
+    return Tags(valid, *(fields.get(field, '') for field in TAG_FIELDS))
+
+
+def _genre_by_number(number):
+    return ID3_GENRES[number] if 0 <= number < len(ID3_GENRES) else ''
+
+
+def _synchsafe(data):
+    """ Integer of ID3v2 synchsafe bytes (7 bits per byte)
+    """
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7f)
+    return value
+
+
+def _id3_text(frame):
+    """ First value of an ID3v2 text frame
+    """
+    if not frame:
+        return ''
+    encoding = ID3_ENCODINGS[frame[0]] if frame[0] < len(ID3_ENCODINGS) else 'latin-1'
+    text = frame[1:].decode(encoding, 'replace').split('\0')[0]
+    return text.replace('\n', ' ').replace('\r', ' ')
+
+
+def _parse_id3v2(data):
+    """ Fields of an ID3v2 tag (versions 2.2 to 2.4), data may be truncated (complete frames are read)
+    """
+    version, flags = data[3], data[5]
+    body = data[10:10 + _synchsafe(data[6:10])]
+    if flags & 0x80 and version < 4:
+        body = body.replace(b'\xff\x00', b'\xff')  # Unsynchronisation of whole tag
+    offset = 0
+    if flags & 0x40 and version == 3:  # Extended header (size without itself)
+        offset = int.from_bytes(body[:4], 'big') + 4
+    elif flags & 0x40 and version == 4:  # Extended header (size with itself)
+        offset = _synchsafe(body[:4])
+    id_size, header_size = (3, 6) if version == 2 else (4, 10)
+
+    fields = {}
+    while offset + header_size <= len(body) and body[offset] != 0:  # Zero byte: padding
+        frame_id = body[offset:offset + id_size]
+        if version == 2:
+            size = int.from_bytes(body[offset + 3:offset + 6], 'big')
+        elif version == 3:
+            size = int.from_bytes(body[offset + 4:offset + 8], 'big')
+        else:
+            size = _synchsafe(body[offset + 4:offset + 8])
+        frame_flags = body[offset + 9] if version > 2 else 0
+        start = offset + header_size
+        offset = start + size
+        field = ID3_FIELDS.get(frame_id)
+        if field is None or field in fields or offset > len(body):
+            continue
+        frame = body[start:offset]
+        if version == 3 and frame_flags & 0xc0 or version == 4 and frame_flags & 0x0c:
+            continue  # Compressed or encrypted
+        if version == 4 and (frame_flags & 0x02 or flags & 0x80):
+            frame = frame.replace(b'\xff\x00', b'\xff')  # Unsynchronisation of frame
+        if version == 4 and frame_flags & 0x01:
+            frame = frame[4:]  # Data length indicator
+        fields[field] = _id3_text(frame)
+
+    match = ID3_GENRE_NUMBER.match(fields.get('genre', ''))
+    if match:
+        fields['genre'] = _genre_by_number(int(match.group(1) or match.group(2)))
+    return fields
+
+
+def _parse_id3v1(data):
+    """ Fields of an ID3v1 tag (last 128 bytes of file)
+    """
+    fields = {}
+    for field, start, end in (('title', 3, 33), ('artist', 33, 63), ('album', 63, 93), ('year', 93, 97)):
+        fields[field] = data[start:end].split(b'\0')[0].decode('latin-1').strip()
+    fields['genre'] = _genre_by_number(data[127])
+    return fields
+
+
+def _parse_vorbis_comment(data):
+    """ Fields of a Vorbis comment block (FLAC)
+    """
+    offset = 4 + int.from_bytes(data[:4], 'little')  # Skip vendor string
+    count = int.from_bytes(data[offset:offset + 4], 'little')
+    offset += 4
+    fields = {}
+    for k in range(count):
+        length = int.from_bytes(data[offset:offset + 4], 'little')
+        if offset + 4 + length > len(data):
+            break  # Corrupt count or length
+        key, _, value = data[offset + 4:offset + 4 + length].partition(b'=')
+        offset += 4 + length
+        field = VORBIS_FIELDS.get(key.upper())
+        if field is not None and field not in fields:
+            fields[field] = value.decode('utf-8', 'replace')
+    return fields
+
+
+def _read_flac(data, offset=4):
+    """ Fields of a FLAC file (metadata blocks from offset, data is a mmap)
+    """
+    while offset + 4 <= len(data):
+        header = data[offset]
+        size = int.from_bytes(data[offset + 1:offset + 4], 'big')
+        offset += 4
+        if header & 0x7f == 4:  # VORBIS_COMMENT
+            return _parse_vorbis_comment(data[offset:offset + size])
+        if header & 0x80:  # Last block
+            break
+        offset += size
+    return {}
+
+
+def _mp4_atoms(data, start, end):
+    """ Atoms between start and end: (type, start of content, end)
+    """
+    offset = start
+    while offset + 8 <= end:
+        size = int.from_bytes(data[offset:offset + 4], 'big')
+        kind = data[offset + 4:offset + 8]
+        header = 8
+        if size == 1:  # 64 bit size
+            size = int.from_bytes(data[offset + 8:offset + 16], 'big')
+            header = 16
+        elif size == 0:  # Up to end of file
+            size = end - offset
+        if size < header:
+            return
+        yield kind, offset + header, min(offset + size, end)
+        offset += size
+
+
+def _read_mp4(data):
+    """ Fields of a MP4 file (moov/udta/meta/ilst, data is a mmap, media data is never touched)
+    """
+    ranges = [(0, len(data))]
+    for path in (b'moov', b'udta', b'meta', b'ilst'):
+        children = [atom for atom in _mp4_atoms(data, *ranges[-1]) if atom[0] == path]
+        if not children:
+            return {}
+        kind, start, end = children[0]
+        ranges.append((start + 4 if kind == b'meta' else start, end))  # meta has version and flags
+
+    fields = {}
+    for kind, start, end in _mp4_atoms(data, *ranges[-1]):
+        field = MP4_FIELDS.get(kind)
+        if field is None or field in fields:
+            continue
+        for child, child_start, child_end in _mp4_atoms(data, start, end):
+            if child == b'data':
+                value = data[child_start + 8:child_end]  # After type and locale
+                if kind == b'gnre':
+                    fields[field] = _genre_by_number(int.from_bytes(value[:2], 'big') - 1)
+                else:
+                    fields[field] = value.decode('utf-8', 'replace')
+                break
+    return fields
 
-try:
-    import chardet
-except ImportError:
-    chardet = None
+
+def read_tags_native(path):
+    """ Read tags of an audio file by parsing only its headers: ID3v2/ID3v1 (MP3), Vorbis
+    comments (FLAC) and atoms (MP4), one bounded read (MP3) or a mmap (FLAC, MP4) per file
+
+    Returns None for other formats.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(TAG_HEADER_SIZE)
+        if head[:3] == b'ID3' and len(head) >= 10:
+            end = 10 + _synchsafe(head[6:10])
+            fields = _parse_id3v2(head)
+            if len(fields) < len(TAG_FIELDS) and end > len(head):
+                head += f.read(end - len(head))  # Frames behind first read (e.g. after a cover)
+                fields = _parse_id3v2(head)
+            if not fields and head[end:end + 4] == b'fLaC':
+                head = None  # FLAC with a (empty) ID3v2 tag in front
+            else:
+                return _tags(fields)
+        else:
+            end = 0
+
+        if head is None or head[:4] == b'fLaC' or head[4:8] == b'ftyp':
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+            with data:
+                if data[end:end + 4] == b'fLaC':
+                    return _tags(_read_flac(data, end + 4))
+                return _tags(_read_mp4(data))
+
+        if len(head) >= 2 and head[0] == 0xff and head[1] & 0xe0 == 0xe0:  # MPEG frame without ID3v2
+            size = os.fstat(f.fileno()).st_size
+            if size >= 128:
+                f.seek(size - 128)
+                data = f.read(128)
+                if data[:3] == b'TAG':
+                    return _tags(_parse_id3v1(data))
+            return _tags({})
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def optional_module(name):
+    """ Import an optional module on first use (None if not installed)
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+def read_tags_hsaudiotag(path):
+    """ Read tags of an audio file with hsaudiotag (more formats, parses more of the file)
+    """
+    hsaudiotag = optional_module('hsaudiotag.auto')  # hsaudiotag3k
+    if hsaudiotag is None:
+        raise ImportError('hsaudiotag3k is not installed')
+    tags = hsaudiotag.File(path)
+    return Tags(bool(tags.valid), tags.artist, tags.album, tags.title, tags.genre, tags.year)
+
+
+# Tag readers tried in this order: name -> function(path) returning Tags or None for unknown formats
+TAG_READERS = collections.OrderedDict([('native', read_tags_native), ('hsaudiotag', read_tags_hsaudiotag)])
+
+
+def read_tags(path, reader='auto'):
+    """ Read tags of an audio file with a tag reader (auto: first reader knowing the format)
+    """
+    if reader != 'auto':
+        tags = TAG_READERS[reader](path)
+    else:
+        tags = None
+        for function in TAG_READERS.values():
+            try:
+                tags = function(path)
+            except ImportError:
+                continue  # Optional reader not installed
+            if tags is not None:
+                break
+    return tags if tags is not None else Tags(False, '', '', '', '', '')
+
+
+def detect_encoding(path):
+    """ Detect encoding of a text playlist: BOM, extension m3u8 (UTF-8) or chardet (stops once confident)
+    """
+    with open(path, 'rb') as f:
+        head = f.read(4)
+        for bom, encoding in BOMS:
+            if head.startswith(bom):
+                return encoding
+        if path.lower().endswith('.m3u8'):
+            return 'utf-8'
+        chardet = optional_module('chardet')
+        if chardet is None:
+            return None  # Locale encoding
+
+        detector = chardet.UniversalDetector()
+        f.seek(0)
+        for line in f:
+            detector.feed(line)
+            if detector.done:
+                break
+        return detector.close()['encoding']
+
+
+def _location_to_path(location, is_uri=False):
+    """ Convert playlist location to path (None for remote locations)
+    """
+    if re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]+://', location):
+        url = urllib.parse.urlsplit(location)
+        if url.scheme.lower() != 'file':
+            return None
+        from urllib import request as urllib_request  # Binding urllib here would shadow the module
+        return urllib_request.url2pathname(url.path)
+    return urllib.parse.unquote(location) if is_uri else location
+
+
+def _read_m3u(path):
+    """ Read locations of a M3U/M3U8 playlist
+    """
+    with open(path, 'r', encoding=detect_encoding(path)) as f:
+        for line in f:
+            line = line.rstrip()
+            if line and not line.startswith('#'):  # Ignore M3U directives
+                yield _location_to_path(line)
+
+
+def _read_pls(path):
+    """ Read locations of a PLS playlist (File1=..., File2=...)
+    """
+    with open(path, 'r', encoding=detect_encoding(path)) as f:
+        for line in f:
+            key, sep, value = line.strip().partition('=')
+            if sep and key.lower().startswith('file') and value:
+                yield _location_to_path(value)
+
+
+def _read_xspf(path):
+    """ Read locations of a XSPF playlist (streamed, parsed tracks are dropped)
+    """
+    import xml.etree.ElementTree as ElementTree
+    for event, element in ElementTree.iterparse(path):
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'location' and element.text and element.text.strip():
+            yield _location_to_path(element.text.strip(), is_uri=True)
+        elif tag == 'track':
+            element.clear()
+
+
+def read_playlist(path):
+    """ Read locations of a playlist (M3U, M3U8, PLS or XSPF), one by one
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.pls':
+        return _read_pls(path)
+    if ext == '.xspf':
+        return _read_xspf(path)
+    return _read_m3u(path)
+
+
+def hash_file(path):
+    """ Content hash of a file (BLAKE2b, read in chunks)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _try_read_tags(path, reader='auto'):
+    """ Read tags of an audio file, return exception instead of raising it
+    """
+    try:
+        return read_tags(path, reader)
+    except Exception as e:
+        return e
+
+
+def read_tags_many(paths, jobs=1, tag_cache=None, metrics=None, reader='auto'):
+    """ Read tags of several files, in parallel if jobs > 1 (result keeps order of paths)
+
+    For files which can't be read the exception is returned instead of tags.
+    """
+    results = [None] * len(paths)
+    pending = []  # Files which must be parsed: (index, path, stat)
+    for k, path in enumerate(paths):
+        stat = None
+        if tag_cache is not None:
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                results[k] = e
+                continue
+            results[k] = tag_cache.get(path, stat, reader)
+            if results[k] is not None:
+                continue
+        pending.append((k, path, stat))
+
+    pending_paths = [path for k, path, stat in pending]
+    if metrics is not None:
+        metrics.count('stat', len(paths) if tag_cache is not None else 0)
+        metrics.count('open', len(pending_paths))
+    read = functools.partial(_try_read_tags, reader=reader)
+    if jobs > 1 and len(pending) > 1:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            parsed = list(executor.map(read, pending_paths))
+    else:
+        parsed = map(read, pending_paths)
+
+    for (k, path, stat), tags in zip(pending, parsed):
+        results[k] = tags
+        if tag_cache is not None and not isinstance(tags, Exception):
+            tag_cache.put(path, stat, tags, reader)
+    return results
+
+
+def default_tag_cache_path():
+    """ Default location of the tag cache (XDG cache directory)
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'playlistcopy', 'tags.sqlite')
+
+
+class TagCache:
+    """ Persistent tag cache (SQLite), keyed by path, size, mtime and tag reader
+
+    A file is only parsed again if its size or modification time or the tag reader changed.
+    Content hashes (for verify mode hash) are cached the same way.
+    Entries which weren't used for max_age seconds are evicted on close.
+    """
+    VERSION = 3
+
+    def __init__(self, path, max_age=30 * 86400):
+        self.path = path
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.hash_hits = 0
+        self.hash_misses = 0
+        self._seen = []
+        self._seen_hashes = []
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        import sqlite3
+        self.db = sqlite3.connect(path)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            self.db.execute('DROP TABLE IF EXISTS tags')
+            self.db.execute('DROP TABLE IF EXISTS hashes')
+            self.db.execute('PRAGMA user_version = %d' % self.VERSION)
+        self.db.execute('CREATE TABLE IF NOT EXISTS tags (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                        'reader TEXT, valid INTEGER, artist TEXT, album TEXT, title TEXT, genre TEXT, year TEXT, '
+                        'seen INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                        'hash TEXT, seen INTEGER)')
+
+    def get(self, path, stat, reader='auto'):
+        """ Get cached tags of a file (read by reader) or None if unknown or stale
+        """
+        row = self.db.execute('SELECT size, mtime_ns, reader, valid, artist, album, title, genre, year FROM tags '
+                              'WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns or row[2] != reader:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._seen.append((path,))
+        return Tags(bool(row[3]), *row[4:])
+
+    def put(self, path, stat, tags, reader='auto'):
+        """ Store tags of a file read by reader (replaces stale entry)
+        """
+        self.db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (path, stat.st_size, stat.st_mtime_ns, reader, int(tags.valid), tags.artist, tags.album,
+                         tags.title, tags.genre, tags.year, int(time.time())))
+
+    def read(self, path, reader='auto'):
+        """ Get tags of a file, parse file only on cache miss
+        """
+        stat = os.stat(path)
+        tags = self.get(path, stat, reader)
+        if tags is None:
+            tags = read_tags(path, reader)
+            self.put(path, stat, tags, reader)
+        return tags
+
+    def get_hash(self, path, stat):
+        """ Get cached content hash of a file or None if unknown or stale
+        """
+        row = self.db.execute('SELECT size, mtime_ns, hash FROM hashes WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            self.hash_misses += 1
+            return None
+        self.hash_hits += 1
+        self._seen_hashes.append((path,))
+        return row[2]
+
+    def put_hash(self, path, stat, digest):
+        """ Store content hash of a file (replaces stale entry)
+        """
+        self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                        (path, stat.st_size, stat.st_mtime_ns, digest, int(time.time())))
+
+    def close(self):
+        """ Mark used entries, evict old entries and write cache to disk
+        """
+        now = int(time.time())
+        self.db.executemany('UPDATE tags SET seen = %d WHERE path = ?' % now, self._seen)
+        self.db.executemany('UPDATE hashes SET seen = %d WHERE path = ?' % now, self._seen_hashes)
+        self.db.execute('DELETE FROM tags WHERE seen < ?', (now - self.max_age,))
+        self.db.execute('DELETE FROM hashes WHERE seen < ?', (now - self.max_age,))
+        self.db.commit()
+        self.db.close()
+        self._seen = []
+        self._seen_hashes = []
+
+
+def sync_filesystem(path):
+    """ Flush all written data of the file system containing path (syncfs, fallback sync)
+    """
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        syncfs = libc.syncfs
+    except (OSError, AttributeError):
+        syncfs = None
+
+    if syncfs is not None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if syncfs(fd) == 0:
+                return
+        finally:
+            os.close(fd)
+    if hasattr(os, 'sync'):
+        os.sync()
+
+
+def sync_filesystems(paths):
+    """ Flush file systems of all paths in parallel (devices are written concurrently)
+    """
+    if len(paths) == 1:
+        sync_filesystem(paths[0])
+        return
+    with concurrent.futures.ThreadPoolExecutor(len(paths)) as executor:
+        for future in [executor.submit(sync_filesystem, path) for path in paths]:
+            future.result()
+
+
+def format_duration(seconds):
+    """ Format duration as h:mm:ss or m:ss
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%d:%02d' % (minutes, seconds)
+
+
+class Inotify:
+    """ Watch directories for changed files (Linux inotify through ctypes)
+    """
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available (Linux only)')
+        if self.fd < 0:
+            self._raise('inotify_init1')
+        self.paths = {}  # Watch descriptor -> directory
+        self.watches = {}  # Directory -> watch descriptor
+
+    def _raise(self, function, path=None):
+        error = self._ctypes.get_errno()
+        raise OSError(error, '%s: %s' % (function, os.strerror(error)), path)
+
+    def add_watch(self, path, mask=INOTIFY_MASK):
+        """ Watch a directory (nothing to do if already watched)
+        """
+        if path in self.watches:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise('inotify_add_watch', path)
+        self.paths[wd] = path
+        self.watches[path] = wd
+
+    def read(self, timeout=None):
+        """ Read events: list of (directory, file name, mask), empty after timeout (seconds, None = no timeout)
+        """
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((self.paths.get(wd), name, mask))
+            if mask & IN_IGNORED:  # Watch removed (e.g. directory deleted)
+                self.watches.pop(self.paths.pop(wd, None), None)
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Metrics:
+    """ Instrumentation of a run: wall and CPU time per phase and counters
+    (stat, scandir and open calls, read and written bytes, cache hits and misses)
+    """
+    def __init__(self):
+        self.phases = collections.OrderedDict()  # Name -> {'wall': s, 'cpu': s, 'calls': n}
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Measure a phase (times of repeated phases are summed up)
+        """
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            phase['wall'] += time.perf_counter() - start_wall
+            phase['cpu'] += time.process_time() - start_cpu
+            phase['calls'] += 1
+
+    def count(self, name, value=1):
+        """ Increase a counter (thread-safe)
+        """
+        with self._lock:
+            self.counters[name] += value
+
+    def add_tag_cache(self, tag_cache):
+        """ Add hits and misses of a tag cache
+        """
+        self.count('tag_cache_hits', tag_cache.hits)
+        self.count('tag_cache_misses', tag_cache.misses)
+        self.count('hash_cache_hits', tag_cache.hash_hits)
+        self.count('hash_cache_misses', tag_cache.hash_misses)
+
+    def to_dict(self):
+        """ All metrics as dict (for JSON)
+        """
+        caches = {}
+        for name in ('tag_cache', 'hash_cache', 'manifest_dirs'):
+            hits = self.counters[name + '_hits']
+            misses = self.counters[name + '_misses']
+            if hits + misses:
+                caches[name] = {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 4)}
+        phases = collections.OrderedDict(
+            (name, {'wall': round(p['wall'], 6), 'cpu': round(p['cpu'], 6), 'calls': p['calls']})
+            for name, p in self.phases.items())
+        return {
+            'wall': round(time.perf_counter() - self._start_wall, 6),
+            'cpu': round(time.process_time() - self._start_cpu, 6),
+            'phases': phases,
+            'counters': dict(sorted(self.counters.items())),
+            'caches': caches,
+        }
+
+    def write(self, path):
+        """ Write metrics as JSON file
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+
+class Journal:
+    """ Journal of the planned actions of a sync, stored in destination
+
+    The first line holds all actions: ['unlink', path, size], ['rmdir', path], ['mkdir', path],
+    ['move', path, new path], ['copy', source, path, size] and ['update', source, path, size]
+    (paths relative to destination). Every further line is a checkpoint: the number of actions done.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def create(self, actions):
+        """ Write all actions (atomically) and open journal for checkpoints
+        """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': JOURNAL_VERSION, 'actions': actions}, f, ensure_ascii=False,
+                      separators=(',', ':'))
+            f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def load(self):
+        """ Read journal of an interrupted sync: (actions, number of actions done) or None
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        lines = content.splitlines()
+        header = json.loads(lines[0])
+        if header['version'] != JOURNAL_VERSION:
+            raise ValueError('Unknown journal version %s' % header['version'])
+        done = 0
+        for line in lines[1:]:
+            try:
+                done = max(done, int(json.loads(line)['done']))
+            except (ValueError, KeyError, TypeError):
+                continue  # Checkpoint torn by interruption
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if not content.endswith('\n'):
+            self.file.write('\n')
+        return header['actions'], done
+
+    def checkpoint(self, done):
+        """ Record that the first done actions are applied (and flushed to disk)
+        """
+        self.file.write('{"done":%d}\n' % done)
+        self.file.flush()
+
+    def remove(self):
+        """ Remove journal (sync finished)
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SyncPlan:
+    """ Planned actions of a sync of one or several destinations (see PlaylistCopy.plan)
+
+    destinations is a list of dicts: destination (absolute path), actions (as in Journal), additions,
+    deletions and updates (counts), bytes (to copy), freed (bytes of deleted files) and
+    folders (folder -> track count after sync, '' is the root). A plan is saved as JSON and can
+    be applied later, even on another machine with the same source paths (PlaylistCopyApply).
+    """
+    VERSION = 1
+
+    def __init__(self, destinations=()):
+        self.destinations = list(destinations)
+
+    @staticmethod
+    def summary(destination, actions, folders):
+        """ Plan of one destination
+        """
+        counts = collections.Counter(action[0] for action in actions)
+        return {'destination': destination, 'additions': counts['copy'], 'deletions': counts['unlink'],
+                'updates': counts['update'],
+                'bytes': sum(action[3] for action in actions if action[0] in ('copy', 'update')),
+                'freed': sum(action[2] for action in actions if action[0] == 'unlink' and len(action) > 2),
+                'folders': folders, 'actions': actions}
+
+    @property
+    def bytes(self):
+        return sum(destination['bytes'] for destination in self.destinations)
+
+    def to_dict(self):
+        return {'version': self.VERSION, 'destinations': self.destinations}
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != cls.VERSION:
+            raise ValueError('Unknown plan version %s' % data.get('version'))
+        return cls(data['destinations'])
+
+    def save(self, path):
+        """ Write plan as JSON (- = stdout)
+        """
+        if path == '-':
+            json.dump(self.to_dict(), sys.stdout, ensure_ascii=False, indent=1)
+            sys.stdout.write('\n')
+            return
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=1)
+            f.write('\n')
+
+    @classmethod
+    def load(cls, path):
+        """ Read plan from JSON (- = stdin)
+        """
+        if path == '-':
+            return cls.from_dict(json.load(sys.stdin))
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+class FileCopier:
+    """ Copy files with a bounded worker pool
+
+    Reading and writing are limited separately (e.g. one read from a HDD while
+    one write to a flash device). Destination files are created in the given order
+    before their content is written, so the order of directory entries (play order
+    on most head units) is deterministic.
+
+    Backends: copy_file_range and sendfile copy inside the kernel, buffered reads
+    and writes chunks of buffer_size. auto uses the first backend which works,
+    a backend rejected by a file system falls back to the next one (at last buffered).
+    Destination files are preallocated with their final size.
+
+    Jobs are tuples (source, size, targets), targets is a list of (destination, path written),
+    the content is written to the latter path (e.g. a temporary file renamed later). Every
+    chunk of a source is read once and written to all targets (by kernel backends the
+    source is only read from disk for the first target, for all others from page cache).
+    events is called with ('progress', dict) after every copied file (see PlaylistCopy).
+    """
+    def __init__(self, logger, read_jobs=1, write_jobs=1, backend='auto', buffer_size=COPY_BUFFER_SIZE,
+                 preallocate=True, metrics=None, events=None):
+        self.logger = logger
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.events = events
+        self.read_jobs = read_jobs
+        self.write_jobs = write_jobs
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate and hasattr(os, 'posix_fallocate')
+        if backend == 'auto':
+            self.backends = [b for b in ('copy_file_range', 'sendfile') if hasattr(os, b)] + ['buffered']
+        elif backend == 'buffered':
+            self.backends = ['buffered']
+        elif not hasattr(os, backend):
+            raise ValueError('Copy backend %s is not available on this system' % backend)
+        else:
+            self.backends = [backend, 'buffered']
+        self._read_slots = threading.BoundedSemaphore(read_jobs)
+        self._write_slots = threading.BoundedSemaphore(write_jobs)
+        self._lock = threading.Lock()
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.bytes_written = 0
+        self.files_done = 0
+        self.files_written = 0
+        self.start_time = 0
+
+    def copy(self, jobs, action='Copying'):
+        """ Copy files, jobs is a list of (source, size, [(destination, path written), ...])
+        """
+        self.bytes_total = sum(job[1] for job in jobs)
+        self.bytes_done = 0
+        self.bytes_written = 0
+        self.files_done = 0
+        self.files_written = 0
+        self.start_time = time.monotonic()
+
+        workers = self.read_jobs + self.write_jobs
+        running = {}  # Future -> job
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            try:
+                for job in jobs:
+                    if len(running) >= workers * 2:
+                        self._wait(running, len(jobs), action, concurrent.futures.FIRST_COMPLETED)
+                    dst_fds = []
+                    try:
+                        for target in job[2]:
+                            dst_fds.append(os.open(target[1], flags, 0o666))  # Create directory entry in given order
+                    except OSError:
+                        for dst_fd in dst_fds:
+                            os.close(dst_fd)
+                        raise
+                    running[executor.submit(self._copy_file, job[0], dst_fds, job[1])] = job
+                self._wait(running, len(jobs), action, concurrent.futures.ALL_COMPLETED)
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
+
+        self.metrics.count('open', self.files_done + self.files_written)
+        self.metrics.count('bytes_read', self.bytes_done)
+        self.metrics.count('bytes_written', self.bytes_written)
+        self.metrics.count('files_copied', self.files_written)
+        duration = time.monotonic() - self.start_time
+        self.logger.info('%s %d files (%.1f MB) took %s (%.1f MB/s)', action, self.files_done,
+                         self.bytes_done / 10**6, format_duration(duration), self._rate(duration))
+
+    def _copy_file(self, src_path, dst_fds, size):
+        """ Copy content of a file chunk by chunk to all destinations (with limited read and write slots)
+        """
+        try:
+            with open(src_path, 'rb') as src_file:
+                src_fd = src_file.fileno()
+                for dst_fd in dst_fds:
+                    if self.preallocate and size > 0:
+                        self._preallocate(dst_fd, size)
+                offset = 0
+                while True:
+                    copied = self._copy_chunk(src_fd, dst_fds, offset, size)
+                    if not copied:
+                        break
+                    offset += copied
+                    with self._lock:
+                        self.bytes_done += copied
+                        self.bytes_written += copied * len(dst_fds)
+                if offset < size:
+                    for dst_fd in dst_fds:
+                        os.ftruncate(dst_fd, offset)  # Source became smaller, remove preallocated space
+        finally:
+            for dst_fd in dst_fds:
+                os.close(dst_fd)
+        with self._lock:
+            self.files_written += len(dst_fds)
+
+    def _preallocate(self, dst_fd, size):
+        """ Allocate space of destination file at once (less fragmentation)
+        """
+        try:
+            os.posix_fallocate(dst_fd, 0, size)
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+            self.preallocate = False
+            self.logger.info('Preallocation not supported (%s), disabled', e)
+
+    def _copy_chunk(self, src_fd, dst_fds, offset, size):
+        """ Copy one chunk at offset to all destinations with the first working backend,
+        returns copied byte count
+        """
+        while True:
+            backend = self.backends[0]
+            try:
+                return getattr(self, '_copy_chunk_' + backend)(src_fd, dst_fds, offset, size)
+            except OSError as e:
+                if backend == 'buffered' or e.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+                with self._lock:
+                    if self.backends[0] == backend:
+                        self.backends.pop(0)
+                        self.logger.info('Copy backend %s not supported (%s), using %s',
+                                         backend, e, self.backends[0])
+
+    def _copy_chunk_copy_file_range(self, src_fd, dst_fds, offset, size):
+        """ Copy chunk inside the kernel (copy_file_range, may use reflinks or server side copy)
+        """
+        count = self.buffer_size
+        for dst_fd in dst_fds:
+            done = 0
+            while done < count:
+                with self._read_slots, self._write_slots:
+                    copied = os.copy_file_range(src_fd, dst_fd, count - done, offset + done, offset + done)
+                if copied == 0:
+                    break  # End of file
+                done += copied
+            if done == 0 and offset < size:
+                # Some file systems return 0 instead of an error
+                raise OSError(errno.EOPNOTSUPP, 'copy_file_range copied nothing')
+            count = done  # Same range for all other destinations
+        return count
+
+    def _copy_chunk_sendfile(self, src_fd, dst_fds, offset, size):
+        """ Copy chunk inside the kernel (sendfile)
+        """
+        count = self.buffer_size
+        for dst_fd in dst_fds:
+            done = 0
+            with self._read_slots, self._write_slots:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                while done < count:
+                    copied = os.sendfile(dst_fd, src_fd, offset + done, count - done)
+                    if copied == 0:
+                        break  # End of file
+                    done += copied
+            count = done  # Same range for all other destinations
+        return count
+
+    def _copy_chunk_buffered(self, src_fd, dst_fds, offset, size):
+        """ Copy chunk through an userspace buffer (read once, written to all destinations)
+        """
+        with self._read_slots:
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            chunk = os.read(src_fd, self.buffer_size)
+        with self._write_slots:
+            for dst_fd in dst_fds:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(dst_fd, view):]
+        return len(chunk)
+
+    def _wait(self, running, files_total, action, return_when):
+        """ Wait for running copies, raise errors and log progress
+        """
+        done, _ = concurrent.futures.wait(running, return_when=return_when)
+        for future in done:
+            src_path, size, targets = running.pop(future)
+            future.result()
+            self.files_done += 1
+            if self.events is not None:
+                self.events('progress', {'source': src_path, 'files_done': self.files_done, 'files_total': files_total,
+                                         'bytes_done': self.bytes_done, 'bytes_total': self.bytes_total})
+            if not self.logger.isEnabledFor(logging.INFO):
+                continue
+
+            duration = time.monotonic() - self.start_time
+            rate = self._rate(duration)
+            remaining = self.bytes_total - self.bytes_done
+            eta = format_duration(remaining / (rate * 10**6)) if rate > 0 else '?'
+            percent = self.files_done / files_total * 100
+            self.logger.info('%s file %s -> %s (%.2f%%, %.1f MB/s, ETA %s)', action, src_path,
+                             ', '.join(target[0] for target in targets), percent, rate, eta)
+
+    def _rate(self, duration):
+        """ Throughput in MB/s
+        """
+        return self.bytes_done / 10**6 / duration if duration > 0 else 0.0
+
+
+class Track:
+    """ Track of playlists or destination (compact record for large plans)
+
+    The path is stored as directory (interned, shared by all tracks of the directory)
+    and file name. name is the file name in destination, key its lowered form (for
+    case-insensitive file systems), folder the number of the destination folder
+    (None: root) and size the size of the source (-1: unknown).
+    """
+    __slots__ = ('directory', 'basename', 'name', 'key', 'folder', 'size')
+
+    def __init__(self, directory, basename, name=None, key=None, folder=None, size=-1):
+        self.directory = directory
+        self.basename = basename
+        self.name = name
+        self.key = key
+        self.folder = folder
+        self.size = size
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.basename)
+
+    def __repr__(self):
+        return 'Track(%r, %r)' % (self.path, self.name)
+
+
+class FolderAllocator:
+    """ Allocate tracks to numbered folders (heap of folders with free slots)
+
+    fill: lowest folder number with a free slot first (folders are filled one after another),
+    balanced: folder with the fewest tracks first (as many folders as needed are used evenly).
+    """
+    PLACEMENTS = ('fill', 'balanced')
+
+    def __init__(self, folders, slots, max_folders=None, placement='fill'):
+        self.folders = folders  # Folder number -> track count (updated on allocation)
+        self.slots = slots  # Maximum track count per folder
+        self.max_folders = max_folders  # Maximum folder count (None = unlimited)
+        self.placement = placement
+        self.created = []  # Numbers of new folders (in order of creation)
+        self.next_number = 1  # Candidate for the number of the next new folder
+
+    def free_slots(self):
+        """ Count of tracks which can be added (None = unlimited)
+        """
+        if self.max_folders is None:
+            return None
+        free = sum(max(self.slots - count, 0) for count in self.folders.values())
+        return free + self._creatable() * self.slots
+
+    def _creatable(self):
+        """ Count of folders which may be created (None = unlimited), the rule of free_slots and allocate
+        """
+        if self.max_folders is None:
+            return None
+        return max(self.max_folders - len(self.folders), 0)
+
+    def allocate(self, count):
+        """ Folder numbers of count new tracks (in order of tracks)
+        """
+        if self.placement == 'balanced':
+            return self._allocate_balanced(count)
+        return self._allocate_fill(count)
+
+    def _allocate_fill(self, count):
+        heap = [number for number, tracks in self.folders.items() if tracks < self.slots]
+        heapq.heapify(heap)
+        numbers = []
+        while len(numbers) < count:
+            new_number = self._new_number() if self._creatable() != 0 else None
+            if heap and (new_number is None or heap[0] < new_number):
+                number = heapq.heappop(heap)
+            elif new_number is not None:
+                number = self._create(new_number)
+            else:
+                raise IOError('No free slot left in %d folders' % len(self.folders))  # See free_slots
+            # Fill folder
+            free = min(self.slots - self.folders[number], count - len(numbers))
+            numbers.extend([number] * free)
+            self.folders[number] += free
+        return numbers
+
+    def _allocate_balanced(self, count):
+        tracks = sum(self.folders.values()) + count
+        folder_count = max(len(self.folders), -(-tracks // self.slots))
+        if self.max_folders is not None:
+            folder_count = max(min(folder_count, self.max_folders), len(self.folders))
+        while len(self.folders) < folder_count:
+            self._create(self._new_number())
+
+        heap = [(tracks, number) for number, tracks in self.folders.items() if tracks < self.slots]
+        heapq.heapify(heap)
+        numbers = []
+        while len(numbers) < count:
+            tracks, number = heapq.heappop(heap)  # IndexError: all folders full (see free_slots)
+            numbers.append(number)
+            self.folders[number] = tracks + 1
+            if tracks + 1 < self.slots:
+                heapq.heappush(heap, (tracks + 1, number))
+        return numbers
+
+    def _new_number(self):
+        """ Lowest folder number which isn't used yet
+        """
+        while self.next_number in self.folders:
+            self.next_number += 1
+        return self.next_number
+
+    def _create(self, number):
+        self.folders[number] = 0
+        self.created.append(number)
+        return number
 
 
 class PlaylistCopy:
     """ playlistcopy is a Python 3 program for merging and copying (and
-    syncing) several tracks of several playlists (m3u/m3u8) to a destination
+    syncing) several tracks of several playlists (m3u/m3u8/pls/xspf) to a destination
     device, even splitted in folders and shuffled.
 
     Dependencies:
-        * Python 3.1 (at least)
-        * hsaudiotag3k (semi-optional)
+        * Python 3.7 (at least)
+        * hsaudiotag3k (optional, tags of formats besides MP3, FLAC and MP4)
         * chardet (optional)
 
     Licence:
         GPLv3+
     """
     def __init__(self, destination, playlists, mode='sync', rewrite_file_names=True, tracks_per_folder=0,
-                 shuffle=False, reshuffle=False, folder_name='Folder %d', verbose=False, dry_run=False):
+                 shuffle=False, reshuffle=False, folder_name='Folder %d', verbose=False, dry_run=False,
+                 tag_cache=None, jobs=1, use_manifest=True, verify='name', read_jobs=1, write_jobs=1,
+                 reshuffle_fraction=1.0, copy_backend='auto', buffer_size=COPY_BUFFER_SIZE, preallocate=True,
+                 metrics=None, also=(), tag_reader='auto', placement='fill', max_folders=0, max_entries=0,
+                 max_name_length=0, read_order='playlist', entry_order='append', events=None):
         self.destination = destination
         self.playlists = playlists
         self.mode = mode
@@ -36,13 +1223,42 @@ class PlaylistCopy:
         self.tracks_per_folder = tracks_per_folder
         self.shuffle = shuffle
         self.reshuffle = reshuffle
+        self.reshuffle_fraction = reshuffle_fraction
         self.folder_name = folder_name
+        self.folder_pattern = None  # Regex of folder names (compiled on first use)
+        self.placement = placement  # Placement of new tracks in folders: fill or balanced
+        self.max_folders = max_folders  # Device limits (0 = unlimited): Folder count,
+        self.max_entries = max_entries  # entries per directory
+        self.max_name_length = max_name_length  # and length of file names
         self.dry_run = dry_run
-
-        self.playlists_files = []
-        self.playlists_files_rewritten = collections.OrderedDict()  # New name -> fs path
-        self.destination_files = []
+        self.tag_cache_path = tag_cache  # None = no tag cache
+        self.tag_cache = None
+        self.tag_reader = tag_reader  # Name of tag reader (see TAG_READERS) or auto
+        self.jobs = jobs
+        self.use_manifest = use_manifest
+        self.verify = verify  # How to detect changed tracks: name, size or hash
+        self.read_jobs = read_jobs
+        self.write_jobs = write_jobs
+        self.copy_backend = copy_backend
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate
+        self.read_order = read_order  # Order of reading sources: playlist, inode or directory
+        self.entry_order = entry_order  # Order of directory entries: append or rewrite (see ENTRY_ORDERS)
+        self.copier = None
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.events = events  # Callable(event, dict) for plan, action, copied, checkpoint and progress
+        self.actions = []  # Planned actions (see Journal)
+        self.also = list(also)  # Further destinations: (destination, tracks per folder, folder name,
+                               # max folders, max entries)
+        self.targets = [self]  # PlaylistCopy of all destinations
+
+        self.tracks = []  # Tracks of all playlists (Track)
+        self.playlists_files_seen = {}  # Source directory -> names of all tracks of playlists in it (also missing)
+        self.source_directories = {}  # Source directory -> names of files in it
+        self.source_stats = {}  # Path -> stat result (only for verify size and hash)
+        self.destination_tracks = []  # Tracks in destination (Track)
         self.destination_folders = collections.OrderedDict()  # Number of files per folder
+        self.destination_listing = {}  # Relative dir path -> [mtime_ns, files, dirs]
 
         self.verbose = verbose
         self.logger = logging.Logger(__name__)
@@ -54,145 +1270,527 @@ class PlaylistCopy:
 
     def run(self):
         """ Start process
-        """
-        for playlist_file in self.playlists:
-            self._parse_playlist(playlist_file)
 
-        self._build_rewritten_filenames()
-        self._build_destination_file_list()
+        Playlists and file names are built once for all destinations (see also),
+        every destination is planned on its own and all are synced together.
+        """
+        self.targets = [self] + [self._create_target(*target) for target in self.also]
+        if not self.dry_run:
+            for plc in self.targets:
+                plc._resume_journal()
 
-        self._sync()
+        self._run_sync()
 
         if self.reshuffle:
-            self.logger.warning('%s: PERFORMING RESHUFFLE' % self.__class__.__name__)
-            plcrs = PlaylistCopyReshuffle(self.destination, self.folder_name,
-                                          self.verbose, self.dry_run)
-            plcrs.run()
+            for plc in self.targets:
+                self.logger.warning('%s: PERFORMING RESHUFFLE', self.__class__.__name__)
+                plcrs = PlaylistCopyReshuffle(plc.destination, plc.folder_name,
+                                              self.verbose, self.dry_run, self.use_manifest, self.reshuffle_fraction,
+                                              self.metrics)
+                plcrs.run()
+
+    def plan(self):
+        """ Plan sync of all destinations without changing them, returns a SyncPlan
+
+        The plan can be inspected, saved and applied later (PlaylistCopyApply).
+        """
+        dry_run = self.dry_run
+        self.dry_run = True  # Destination isn't changed, not even cleaned up while scanning
+        try:
+            self.targets = [self] + [self._create_target(*target) for target in self.also]
+            for plc in self.targets:
+                if os.path.exists(os.path.join(plc.destination, JOURNAL_NAME)):
+                    raise IOError('Destination %s has an interrupted sync, finish it first' % plc.destination)
+            self._run_sync(apply=False)
+        finally:
+            self.dry_run = dry_run
+        return SyncPlan(plc._summary() for plc in self.targets)
+
+    def _summary(self):
+        """ Plan of this destination (see SyncPlan)
+        """
+        if self.tracks_per_folder == 0:
+            folders = {'': len(self.destination_tracks)}
+        else:
+            folders = collections.OrderedDict((self.folder_name % number, count)
+                                              for number, count in self.destination_folders.items())
+        return SyncPlan.summary(os.path.abspath(self.destination), self.actions, folders)
+
+    def _emit(self, event, **data):
+        """ Call events callback (if any)
+        """
+        if self.events is not None:
+            self.events(event, data)
+
+    def _run_sync(self, scan=True, apply=True):
+        """ Parse playlists, rewrite file names, scan destinations (if scan) and sync all destinations
+        (plan only if not apply)
+        """
+        self.tracks = []
+        self.playlists_files_seen = {}
+        with self.metrics.phase('parse_playlists'):
+            for playlist_file in self.playlists:
+                self._parse_playlist(playlist_file)
+
+        if self.tag_cache_path is not None and (self.rewrite_file_names or self.verify == 'hash'):
+            self.tag_cache = TagCache(self.tag_cache_path)
+        try:
+            if self.verify == 'hash':
+                with self.metrics.phase('drop_duplicate_contents'):
+                    self._drop_duplicate_contents()
+            with self.metrics.phase('rewrite_filenames'):
+                self._build_rewritten_filenames()
+            for plc in self.targets[1:]:
+                plc.tracks = self.tracks
+                plc.source_stats = self.source_stats
+                plc.tag_cache = self.tag_cache
+            if scan:
+                with self.metrics.phase('scan_destination'):
+                    for plc in self.targets:
+                        plc._build_destination_file_list()
+
+            self._sync(self.targets, apply)
+        finally:
+            if self.tag_cache is not None:
+                self.logger.info('Tag cache: %d hits, %d misses', self.tag_cache.hits, self.tag_cache.misses)
+                self.metrics.add_tag_cache(self.tag_cache)
+                self.tag_cache.close()
+                for plc in self.targets:
+                    plc.tag_cache = None
+        if apply and not self.dry_run:
+            with self.metrics.phase('write_manifest'):
+                for plc in self.targets:
+                    plc._write_manifest()
+
+    def _reset_destination(self):
+        """ Forget files of destination (scanned again)
+        """
+        self.destination_tracks = []
+        self.destination_folders = collections.OrderedDict()
+        self.destination_listing = {}
+
+    def _create_target(self, destination, tracks_per_folder=None, folder_name=None, max_folders=None,
+                       max_entries=None):
+        """ PlaylistCopy of a further destination (same options, except tracks per folder, folder name
+        and device limits)
+        """
+        plc = PlaylistCopy(destination, self.playlists, self.mode, self.rewrite_file_names,
+                           self.tracks_per_folder if tracks_per_folder is None else tracks_per_folder,
+                           self.shuffle, self.reshuffle, self.folder_name if folder_name is None else folder_name,
+                           self.verbose, self.dry_run, use_manifest=self.use_manifest, verify=self.verify,
+                           metrics=self.metrics, events=self.events, placement=self.placement,
+                           entry_order=self.entry_order,
+                           max_folders=self.max_folders if max_folders is None else max_folders,
+                           max_entries=self.max_entries if max_entries is None else max_entries)
+        plc.logger = self.logger
+        return plc
 
     def _parse_playlist(self, file):
-        """ Parse a M3U playlist
+        """ Parse a playlist (M3U, M3U8, PLS or XSPF), skip missing tracks and tracks already seen
+        """
+        for full_path in self._playlist_paths(file):
+            directory, name = os.path.split(full_path)
+            directory = sys.intern(directory)
+            seen = self.playlists_files_seen.setdefault(directory, set())
+            if name in seen:
+                self.logger.info('File is on several playlists and copied once: %s', full_path)
+                continue
+            seen.add(name)
+
+            if not self._source_file_exists(directory, name):
+                self.logger.warning('File doesn\'t exist and is skipped: %s', full_path)
+            else:
+                self.tracks.append(Track(directory, name))
+
+    def _playlist_paths(self, file):
+        """ Full paths of all local tracks of a playlist
         """
         file_dir = os.path.dirname(os.path.realpath(file))
+        self.metrics.count('open', 1 if file.lower().endswith('.xspf') else 2)  # Encoding detection + parsing
 
-        # Deal with file encoding
-        encoding = None
-        if chardet is not None:
-            result = chardet.detect(open(file, 'rb').read())
-            encoding = result['encoding']
-
-        with open(file, 'r', encoding=encoding) as f:
-            for line in f:
-                if line.startswith('#'):
-                    continue  # Ignore M3U directives
-                full_path = os.path.join(file_dir, line.rstrip())
-                if not os.path.isfile(full_path):
-                    self.logger.warning('File doesn\'t exist and is skipped: %s' % full_path)
-                else:
-                    self.playlists_files.append(full_path)
+        for location in read_playlist(file):
+            if location is None:
+                continue  # Remote location (e.g. http)
+            yield os.path.normpath(os.path.join(file_dir, location))
 
-    def _build_destination_file_list(self):
-        """ Build list of all files of destination folder
+    def _source_file_exists(self, directory, name):
+        """ Check if a source file exists (one scandir per source directory, a stat for names
+        not found, e.g. in other case on case-insensitive file systems)
         """
-        for f in os.listdir(self.destination):
-            path = os.path.join(self.destination, f)
+        names = self.source_directories.get(directory)
+        if names is None:
+            names = set()
+            self.metrics.count('scandir')
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            names.add(entry.name)
+            except OSError:
+                pass  # Missing directory: no files
+            self.source_directories[directory] = names
+        if name in names:
+            return True
+        self.metrics.count('stat')
+        return os.path.isfile(os.path.join(directory, name))
 
-            # Don't iterate through sub directories when no folders are used
-            if self.tracks_per_folder == 0:
-                if os.path.isfile(path):
-                    self.destination_files.append(path)
-            else:
+    def _build_destination_file_list(self):
+        """ Build list of all files of destination folder (use manifest of last run where still valid)
+        """
+        manifest = self._load_manifest() if self.use_manifest else None
+        root = self._list_directory('', manifest)
+
+        # Don't iterate through sub directories when no folders are used
+        if self.tracks_per_folder == 0:
+            directory = sys.intern(self.destination)
+            for f in root[1]:
+                self.destination_tracks.append(Track(directory, f, f, f.lower()))
+        else:
+            for f in root[2]:
                 # Check if folder name matchs folder name format
                 folder_number = self._extract_folder_number(f)
                 if folder_number is None:
                     continue  # Folder name doesn't match format
 
-                self.destination_folders[folder_number] = 0
-                for f2 in os.listdir(path):
-                    path2 = os.path.join(self.destination, f, f2)
-                    if os.path.isfile(path2):  # Ignore sub sub directories
-                        self.destination_files.append(path2)
-                        self.destination_folders[folder_number] += 1
+                files = self._list_directory(f, manifest)[1]  # Ignore sub sub directories
+                self.destination_folders[folder_number] = len(files)
+                directory = sys.intern(os.path.join(self.destination, f))
+                for f2 in files:
+                    self.destination_tracks.append(Track(directory, f2, f2, f2.lower(), folder_number))
+
+    def _list_directory(self, folder, manifest=None):
+        """ List files and sub directories of a destination directory
+
+        The listing of the manifest is used if the directory wasn't modified since.
+        """
+        path = os.path.join(self.destination, folder)
+        mtime_ns = os.stat(path).st_mtime_ns
+        self.metrics.count('stat')
+        if manifest is not None:
+            entry = manifest['dirs'].get(folder)
+            if entry is not None and self._manifest_entry_valid(path, entry, mtime_ns, manifest['written_ns']):
+                self.metrics.count('manifest_dirs_hits')
+                self.destination_listing[folder] = entry
+                return entry
+            self.metrics.count('manifest_dirs_misses')
+
+        self.metrics.count('scandir')
+        files = []
+        dirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith(INTERNAL_PREFIX):
+                    if self.dry_run:
+                        continue
+                    if entry.name.endswith(PART_SUFFIX):
+                        self.logger.info('Deleting partial file %s', entry.path)
+                        os.unlink(entry.path)  # Left by an interrupted sync without journal
+                    elif entry.name == STAGING_NAME and not folder and entry.is_dir():
+                        self._clean_staging(entry.path)
+                    continue
+                if entry.is_file():
+                    files.append(entry.name)
+                elif entry.is_dir():
+                    dirs.append(entry.name)
+        self.destination_listing[folder] = [mtime_ns, files, dirs]
+        return self.destination_listing[folder]
+
+    def _clean_staging(self, path):
+        """ Delete partial files left in the staging folder by an interrupted sync without journal,
+        remove the staging folder if empty
+        """
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith(INTERNAL_PREFIX) and entry.name.endswith(PART_SUFFIX):
+                    self.logger.info('Deleting partial file %s', entry.path)
+                    os.unlink(entry.path)
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass  # Still holds files of an interrupted rewrite of entry order
+
+    def _manifest_entry_valid(self, path, entry, mtime_ns, written_ns):
+        """ Check if the listing of a directory in the manifest is still valid: same mtime and
+        some of its files (random sample) still exist
+        """
+        # No timestamp (e.g. root directory on FAT): modifications can't be detected
+        if mtime_ns == 0 or entry[0] != mtime_ns:
+            return False
+        # Modifications within mtime granularity before writing the manifest can't be detected
+        if mtime_ns + MANIFEST_RACY_NS > written_ns:
+            return False
+        for name in random.sample(entry[1], min(MANIFEST_SAMPLE, len(entry[1]))):
+            self.metrics.count('stat')
+            if not os.path.isfile(os.path.join(path, name)):
+                return False
+        return True
+
+    def _load_manifest(self):
+        """ Load manifest of destination written by last run (None if missing or invalid)
+        """
+        try:
+            self.metrics.count('open')
+            with open(os.path.join(self.destination, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest['version'] != MANIFEST_VERSION:
+                raise ValueError('Unknown manifest version %s' % manifest['version'])
+            manifest['written_ns'] = int(manifest['written_ns'])
+            return manifest
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning('Manifest is invalid and ignored (%s)', e)
+            return None
+
+    def _write_manifest(self):
+        """ Write manifest of destination: files of root and of all folders plus their mtimes
+        """
+        path = os.path.join(self.destination, MANIFEST_NAME)
+        if not os.path.exists(path):
+            open(path, 'w').close()  # Create first, rewriting an existing file doesn't change mtime of root
+
+        root = self.destination_listing.get('', [None, [], []])
+        if self.tracks_per_folder == 0:
+            dirs = {'': [None, [track.basename for track in self.destination_tracks], root[2]]}
+        else:
+            folders = {n: self.folder_name % n for n in self.destination_folders}
+            root_dirs = [f for f in root[2] if self._extract_folder_number(f) is None] + list(folders.values())
+            dirs = {'': [None, root[1], root_dirs]}
+            for folder in folders.values():
+                dirs[folder] = [None, [], []]
+            for track in self.destination_tracks:
+                dirs[folders[track.folder]][1].append(track.basename)
+
+        for folder, entry in dirs.items():
+            entry[0] = os.stat(os.path.join(self.destination, folder)).st_mtime_ns
+        self.metrics.count('stat', len(dirs))
+        self.metrics.count('open')
+        manifest = {'version': MANIFEST_VERSION, 'written_ns': time.time_ns(), 'dirs': dirs}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, separators=(',', ':'))
+        self.destination_listing = dirs
 
     def _build_rewritten_filenames(self):
-        """ Rewrite file names of playlists for destination folder
+        """ Rewrite file names of playlists for destination folder (name and key of tracks)
         """
-        for k, f in enumerate(self.playlists_files):
-            name, ext = os.path.splitext(os.path.basename(f))
+        if self.rewrite_file_names:
+            all_tags = self._read_tags()
+
+        errors = []
+        used_names = set()  # Lowered names, needed for case-insensitive file systems
+        next_suffix = {}  # Lowered (name, ext) -> first suffix number which may be free
+        for k, track in enumerate(self.tracks):
+            name, ext = os.path.splitext(track.basename)
+            limit = self.max_name_length - len(ext) if self.max_name_length else None  # Without extension
+            if limit is not None and limit < 1:
+                errors.append('Name is too long (max %d characters) %s' % (self.max_name_length, track.path))
+                continue
 
             # Rewrite file names to ID3 tags
-            # TODO Maximum filename length on some file systems
             if self.rewrite_file_names:
-                from hsaudiotag import auto  # hsaudiotag3k
-                tags = auto.File(f)
+                tags = all_tags[k]
+                if isinstance(tags, Exception):
+                    errors.append('Tags can\'t be read %s (%s)' % (track.path, tags))
+                    continue
                 if not tags.artist.strip():
-                    raise IOError('Tag artist is empty %s' % f)
+                    errors.append('Tag artist is empty %s' % track.path)
+                    continue
                 if not tags.album.strip():
-                    raise IOError('Tag album is empty %s' % f)
+                    errors.append('Tag album is empty %s' % track.path)
+                    continue
                 if not tags.title.strip():
-                    raise IOError('Tag title is empty %s' % f)
+                    errors.append('Tag title is empty %s' % track.path)
+                    continue
                 name = '%s - %s - %s' % (tags.artist, tags.album, tags.title)  # Actually - should be –
                 name = re.sub('[^\w\s()-\.\']', '', name).strip()
 
             # Check if file with same potential filename already exists in same PL
-            # If so, append (1), (2), etc. to filename
-            nth_file = 0
+            # If so, append (2), (3), etc. to filename (names are shortened to maximum length)
+            base_key = (name.lower(), ext.lower())
+            nth_file = next_suffix.get(base_key, 1)
             while True:
-                nth_file += 1
                 nth = ' (%d)' % nth_file if nth_file > 1 else ''
-                new_name = '%s%s' % (name, nth)
-                # Compare lowered names, needed for case-insensitive file systems
-                rewritten_lower = map(lambda n: n.lower(), self.playlists_files_rewritten.values())
-                if (new_name + ext).lower() not in rewritten_lower:
+                if limit is not None and len(name) + len(nth) > limit:
+                    new_name = '%s%s' % (name[:max(limit - len(nth), 1)].rstrip(), nth)
+                else:
+                    new_name = '%s%s' % (name, nth)
+                key = (new_name + ext).lower()
+                if key not in used_names:
                     name = new_name
                     break
+                nth_file += 1
+            next_suffix[base_key] = nth_file + 1
+            used_names.add(key)
+
+            track.name = name + ext
+            track.key = key
+
+        if errors:
+            raise IOError('Tags of %d files are invalid:\n%s' % (len(errors), '\n'.join(errors)))
+
+    def _read_tags(self):
+        """ Tags of all tracks (in order, exception instead of tags if unreadable)
+        """
+        paths = [track.path for track in self.tracks]
+        return read_tags_many(paths, self.jobs, self.tag_cache, self.metrics, self.tag_reader)
+
+    def _drop_duplicate_contents(self):
+        """ Drop tracks with same content as a previous track (reached through another path)
+
+        Only tracks with same size are hashed.
+        """
+        by_size = collections.defaultdict(list)
+        for track in self.tracks:
+            by_size[self._source_size(track)].append(track)
+
+        duplicates = set()
+        for tracks in by_size.values():
+            if len(tracks) < 2:
+                continue
+            hashes = {}
+            for track in tracks:
+                path = track.path
+                digest = self._hash(path, self._source_stat(path))
+                if digest in hashes:
+                    self.logger.info('File has same content as %s and is skipped: %s', hashes[digest], path)
+                    duplicates.add(track)
+                else:
+                    hashes[digest] = path
 
-            self.playlists_files_rewritten[k] = name + ext
+        if duplicates:
+            self.tracks = [track for track in self.tracks if track not in duplicates]
 
     def _compare(self):
-        """ Determine which tracks become added and which tracks become removed
+        """ Determine which tracks become added, which tracks become removed and
+        which tracks become updated (changed content, only with verify size or hash)
+
+        Tracks are compared by key (lowered name, for case-insensitive file systems).
         """
-        # Filenames for comparison (lowered names needed for case-insensitive file systems)
-        pl_filenames = [name.lower() for name in self.playlists_files_rewritten.values()]
-        dst_filenames = [os.path.basename(f).lower() for f in self.destination_files]
+        pl_index = set(track.key for track in self.tracks)
+        dst_index = {track.key: k for k, track in enumerate(self.destination_tracks)}
 
         # Some assertions
-        if len(self.playlists_files) != len(set(self.playlists_files_rewritten)):
+        if len(self.tracks) != len(pl_index):
             raise AssertionError('Playlist files don\'t contain unique filenames only (error in file renaming?)')
-        if len(dst_filenames) != len(set(dst_filenames)):
+        if len(self.destination_tracks) != len(dst_index):
             raise AssertionError('Destination files don\'t contain unique filenames only (across all folders)')
 
         # Compare: New files and files to delete (only compare filenames)
-        additions = collections.OrderedDict()
-        deletions = {}
-        for k, name in enumerate(pl_filenames):
-            if name not in dst_filenames:
-                additions[k] = self.playlists_files[k]
-        for k, dst_file in enumerate(dst_filenames):
-            if dst_file not in pl_filenames:
-                deletions[k] = self.destination_files[k]
-
-        return additions, deletions
-
-    def _sync(self):
-        """ Sync: Get additions and deletions, shuffling, execute sync
+        additions = collections.OrderedDict()  # Index -> source track
+        deletions = {}  # Index -> destination track
+        updates = collections.OrderedDict()  # Index of source track -> destination track
+        for k, track in enumerate(self.tracks):
+            j = dst_index.get(track.key)
+            if j is None:
+                additions[k] = track
+            elif self.verify != 'name':
+                dst_track = self.destination_tracks[j]
+                if self._is_changed(track, dst_track):
+                    updates[k] = dst_track
+        for k, track in enumerate(self.destination_tracks):
+            if track.key not in pl_index:
+                deletions[k] = track
+
+        return additions, deletions, updates
+
+    def _is_changed(self, track, dst_track):
+        """ Check if content of source differs from destination (size first, hash second)
         """
-        self.logger.warning('All playlists have %d tracks' % len(self.playlists_files))
+        src_file = track.path
+        dst_file = dst_track.path
+        src_stat = self._source_stat(src_file)
+        dst_stat = os.stat(dst_file)
+        self.metrics.count('stat')
+        if src_stat.st_size != dst_stat.st_size:
+            return True
+        if self.verify == 'size':
+            return False
+        # Destination written after last modification of source: content must be the same
+        if src_stat.st_mtime_ns <= dst_stat.st_mtime_ns:
+            return False
+        return self._hash(src_file, src_stat) != self._hash(dst_file, dst_stat)
+
+    def _source_stat(self, path):
+        """ Stat of a source file (only one stat per file and run)
+        """
+        if path not in self.source_stats:
+            self.source_stats[path] = os.stat(path)
+            self.metrics.count('stat')
+        return self.source_stats[path]
 
-        additions, deletions = self._compare()
+    def _source_size(self, track):
+        """ Size of a source track (one stat per track and run)
+        """
+        if track.size < 0:
+            stat = self.source_stats.get(track.path)
+            if stat is None:
+                stat = os.stat(track.path)
+                self.metrics.count('stat')
+            track.size = stat.st_size
+        return track.size
+
+    def _hash(self, path, stat):
+        """ Content hash of a file (cached in tag cache)
+        """
+        digest = self.tag_cache.get_hash(path, stat) if self.tag_cache is not None else None
+        if digest is None:
+            digest = hash_file(path)
+            self.metrics.count('open')
+            self.metrics.count('bytes_read', stat.st_size)
+            if self.tag_cache is not None:
+                self.tag_cache.put_hash(path, stat, digest)
+        return digest
+
+    def _sync(self, targets=None, apply=True):
+        """ Sync: Plan additions, deletions and updates of all destinations, execute sync (if apply)
+        """
+        targets = targets or [self]
+        self.logger.warning('All playlists have %d tracks', len(self.tracks))
+        if self.dry_run and apply:
+            self.logger.warning('%s: PERFORMING DRY RUN', self.__class__.__name__)
+
+        # Plan all actions first, then apply them journaled
+        with self.metrics.phase('plan'):
+            for plc in targets:
+                if len(targets) > 1:
+                    self.logger.warning('Destination %s:', plc.destination)
+                plc._plan()
+                if self.events is not None:
+                    summary = plc._summary()
+                    del summary['actions']
+                    self._emit('plan', **summary)
+
+        if apply and not self.dry_run:
+            runs = []
+            for plc in targets:
+                if plc.actions:
+                    journal = Journal(os.path.join(plc.destination, JOURNAL_NAME))
+                    journal.create(plc.actions)
+                    runs.append((plc, journal, plc.actions, 0))
+            if runs:
+                self._apply_actions(runs)
+
+    def _plan(self):
+        """ Plan sync of this destination: Get additions and deletions, shuffling
+        """
+        with self.metrics.phase('compare'):
+            additions, deletions, updates = self._compare()
 
         if self.mode == 'sync':
             info_deletions = '%d deletions' % len(deletions)
         else:
             info_deletions = '0 deletions (disabled)'
-        self.logger.warning('%d additions, %s' % (len(additions), info_deletions))
-
-        if self.dry_run:
-            self.logger.warning('%s: PERFORMING DRY RUN' % self.__class__.__name__)
+        if self.verify != 'name':
+            info_deletions += ', %d updates' % len(updates)
+        self.logger.warning('%d additions, %s', len(additions), info_deletions)
 
+        self.actions = []
         # In sync mode: delete files not matched
         if self.mode == 'sync':
             self._sync_deletions(deletions)
 
+        self._sync_updates(updates)
+
         if self.shuffle:  # Shuffle works only for new tracks here
             keys = list(additions)
             random.shuffle(keys)
@@ -201,99 +1799,399 @@ class PlaylistCopy:
 
         self._sync_additions(additions)
 
+        if self.entry_order == 'rewrite':
+            self._sync_entry_order()
+
+    def _sync_updates(self, updates):
+        """ Sync updates: Overwrite files with changed content
+        """
+        jobs = []
+        for k, dst_track in updates.items():
+            track = self.tracks[k]
+            jobs.append((track.path, dst_track.path, self._source_size(track)))
+        self._copy_files(jobs, 'update')
+
     def _sync_additions(self, additions):
         """ Sync additions: Create needed folders and copy files
         """
-        folder_mapping = self._prepare_copying_additions(additions)
-
-        tracks_done = 0
-        for k, f in additions.items():
-            tracks_done += 1
-            dst_path = os.path.join(folder_mapping[k], self.playlists_files_rewritten[k])
-            percent = tracks_done / len(additions) * 100
-            self.logger.info('Copying file %s -> %s (%.2f%%)' % (f, dst_path, percent))
-            if not self.dry_run:
-                shutil.copyfile(f, dst_path)
-
-    def _prepare_copying_additions(self, additions):
-        """ Prepare copying: Create folders and allocate files to folders
+        with self.metrics.phase('prepare_copying_additions'):
+            self._prepare_copying_additions(additions)
+
+        jobs = []
+        folder_paths = {None: sys.intern(self.destination)}
+        for track in additions.values():
+            if track.folder not in folder_paths:
+                folder_paths[track.folder] = sys.intern(self._create_folder_path(track.folder))
+            dst_track = Track(folder_paths[track.folder], track.name, track.name, track.key, track.folder,
+                              self._source_size(track))
+            jobs.append((track.path, dst_track.path, dst_track.size))
+            self.destination_tracks.append(dst_track)
+        self._copy_files(jobs, 'copy')
+
+    def _sync_entry_order(self):
+        """ Rewrite directory entries of all changed folders in play order
+
+        On FAT the order of directory entries is the play order of most head units, but new
+        entries may fill gaps left by deleted or renamed files. All files of a changed folder
+        are moved to a staging folder and back in play order, so the emptied folder is filled
+        from its start.
         """
-        mapping = {}
-        tracks_stack = additions.copy()
-        folder_count = 0
-
+        changed = set(os.path.dirname(action[-2] if action[0] in ('copy', 'update') else action[1])
+                      for action in self.actions if action[0] in ('unlink', 'copy', 'update'))
+        folders = collections.OrderedDict()  # Relative folder -> tracks (in play order)
+        for track in self.destination_tracks:
+            folder = os.path.dirname(self._relative_path(track.path))
+            if folder in changed:
+                folders.setdefault(folder, []).append(track)
+        if not folders:
+            return
+
+        self.logger.info('Rewriting order of directory entries in %d folders', len(folders))
+        self.actions.append(['mkdir', STAGING_NAME])
+        for folder, tracks in folders.items():
+            for track in tracks:
+                self.actions.append(['move', os.path.join(folder, track.basename),
+                                     os.path.join(STAGING_NAME, track.basename)])
+            for track in tracks:
+                self.actions.append(['move', os.path.join(STAGING_NAME, track.basename),
+                                     os.path.join(folder, track.basename)])
+        self.actions.append(['rmdir', STAGING_NAME])
+
+    def _copy_files(self, jobs, kind='copy'):
+        """ Plan copies (kind copy or update) of files (list of (source, destination, size))
+        """
+        log = self.dry_run and self.logger.isEnabledFor(logging.INFO)
+        for k, job in enumerate(jobs):
+            if log:
+                percent = (k + 1) / len(jobs) * 100
+                action = 'Copying' if kind == 'copy' else 'Updating'
+                self.logger.info('%s file %s -> %s (%.2f%%)', action, job[0], job[1], percent)
+            self.actions.append([kind, job[0], self._relative_path(job[1]), job[2]])
+
+    def _relative_path(self, path):
+        """ Path relative to destination (as stored in journal)
+        """
+        prefix = os.path.join(self.destination, '')
+        if path.startswith(prefix):
+            return path[len(prefix):]
+        return os.path.relpath(path, self.destination)
+
+    def _resume_journal(self):
+        """ Finish the actions of an interrupted sync (if a journal is left in destination),
+        returns the finished actions or None
+        """
+        journal = Journal(os.path.join(self.destination, JOURNAL_NAME))
+        try:
+            state = journal.load()
+        except (OSError, ValueError, KeyError, TypeError, IndexError) as e:
+            self.logger.warning('Journal is invalid and discarded (%s)', e)
+            journal.remove()
+            return None
+        if state is None:
+            return None
+
+        actions, done = state
+        self.logger.warning('Resuming interrupted sync of %s: %d of %d actions left',
+                            self.destination, len(actions) - done, len(actions))
+        with self.metrics.phase('resume'):
+            self._apply_actions([(self, journal, actions, done)], resumed=True)
+        return actions
+
+    def _apply_actions(self, runs, resumed=False):
+        """ Apply planned actions of one or several destinations, with checkpoints in their journals
+
+        runs is a list of (PlaylistCopy of destination, journal, actions, index of first action).
+        Copies are written to temporary files in the staging folder, flushed in batches and
+        renamed to their final names afterwards (in planned order), so a file with its final
+        name is always complete. Deletions and creations of folders can be repeated safely.
+        The batches of all destinations are copied together: each source file is read
+        once and written to all destinations needing it, all devices are flushed in parallel.
+        """
+        positions = [run[3] for run in runs]
         while True:
-            folder_count += 1
-
-            if len(tracks_stack) == 0:
+            batches = []  # (index of run, indexes of copies)
+            for n, (plc, journal, actions, done) in enumerate(runs):
+                k = positions[n]
+                # Deletions, creations of folders and moves up to the next copy
+                first = k
+                while k < len(actions) and actions[k][0] not in ('copy', 'update'):
+                    k += 1
+                if k > first:
+                    plc._apply_batch(actions[first:k])
+                batch = []
+                batch_bytes = 0
+                kind = actions[k][0] if k < len(actions) else None  # Copies and updates are separate batches
+                while k < len(actions) and actions[k][0] == kind and batch_bytes < JOURNAL_CHECKPOINT_BYTES:
+                    batch.append(k)
+                    batch_bytes += actions[k][3]
+                    k += 1
+                positions[n] = k
+                if batch:
+                    batches.append((n, batch))
+            if not batches:
                 break
-
-            if self.tracks_per_folder != 0:
-                folder_path = self._create_folder_path(folder_count)
-
-                # Create needed folder which currently does not exist
-                if folder_count not in self.destination_folders:
-                    self.logger.info('Creating folder "%s"' % folder_path)
-                    if not self.dry_run:
-                        os.mkdir(folder_path)
-
-                    self.destination_folders[folder_count] = 0
-                    remainder = self.tracks_per_folder
-                else:
-                    tracks_in_folder = self.destination_folders[folder_count]
-                    if tracks_in_folder >= self.tracks_per_folder:
-                        continue  # Skip full folder
-                    else:
-                        remainder = self.tracks_per_folder - tracks_in_folder
+            self._apply_copies(runs, batches, positions, resumed)
+
+        for run in runs:
+            try:
+                os.rmdir(os.path.join(run[0].destination, STAGING_NAME))
+            except OSError:
+                pass  # No copies
+        # Flush last renames and deletions before the journals are dropped
+        with self.metrics.phase('flush'):
+            sync_filesystems([run[0].destination for run in runs])
+        for run in runs:
+            run[1].remove()
+
+    def _apply_batch(self, actions):
+        """ Apply consecutive deletions, creations of folders and moves (nothing to do if already done)
+
+        Files and folders are deleted relative to a descriptor of their parent directory,
+        so their paths aren't resolved again for every file. Deletions are planned folder by
+        folder, only the descriptor of the current directory is kept open.
+        """
+        use_dir_fd = os.unlink in os.supports_dir_fd and os.rmdir in os.supports_dir_fd
+        dir_fds = {}  # Relative path of current directory -> descriptor (one entry at most)
+        deleted = 0
+        freed = 0
+        try:
+            for kind, group in itertools.groupby(actions, key=lambda action: action[0]):
+                with self.metrics.phase({'mkdir': 'mkdir', 'move': 'entry_order'}.get(kind, 'deletions')):
+                    for action in group:
+                        if kind not in ('unlink', 'rmdir') or not use_dir_fd:
+                            self._apply_action(action)
+                        elif self._delete(action, dir_fds) and kind == 'unlink':
+                            deleted += 1
+                            freed += action[2] if len(action) > 2 else 0
+        finally:
+            for dir_fd in dir_fds.values():
+                os.close(dir_fd)
+        if deleted:
+            self.metrics.count('bytes_freed', freed)
+            self.logger.info('Deleted %d files in %s (%.1f MB freed)', deleted, self.destination, freed / 10**6)
+
+    def _delete(self, action, dir_fds):
+        """ Delete a file or a folder relative to the descriptor of its parent directory,
+        returns False if already deleted
+        """
+        kind, path = action[:2]
+        directory, name = os.path.split(path)
+        if kind == 'rmdir' and path in dir_fds:
+            os.close(dir_fds.pop(path))
+        try:
+            dir_fd = dir_fds.get(directory)
+            if dir_fd is None:
+                for fd in dir_fds.values():
+                    os.close(fd)  # Directory changed
+                dir_fds.clear()
+                dir_fd = os.open(os.path.join(self.destination, directory), os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+                dir_fds[directory] = dir_fd
+            if kind == 'unlink':
+                os.unlink(name, dir_fd=dir_fd)
             else:
-                remainder = len(tracks_stack)  # Remainer is as high as track count
-                folder_path = self.destination  # No directory must be created
+                os.rmdir(name, dir_fd=dir_fd)
+        except FileNotFoundError:
+            return False  # Applied before interruption
+        self.metrics.count(kind)
+        self._emit('action', destination=self.destination, action=action)
+        return True
+
+    def _apply_action(self, action):
+        """ Apply a deletion, a creation of a folder or a move (nothing to do if already done)
+        """
+        kind, path = action[:2]
+        path = os.path.join(self.destination, path)
+        try:
+            if kind == 'unlink':
+                os.unlink(path)
+            elif kind == 'rmdir':
+                os.rmdir(path)
+            elif kind == 'mkdir':
+                os.mkdir(path)
+            elif kind == 'move':
+                os.rename(path, os.path.join(self.destination, action[2]))
+            else:
+                raise ValueError('Unknown action %s in journal' % kind)
+        except (FileNotFoundError, FileExistsError):
+            return  # Applied before interruption
+        self.metrics.count(kind)
+        self._emit('action', destination=self.destination, action=action)
+
+    def _apply_copies(self, runs, batches, positions, resumed=False):
+        """ Copy batches of files to temporary files, flush and rename them, then write checkpoints
+
+        The temporary files are written to the staging folder in destination root, not to
+        the target folder: on FAT a rename within a folder leaves a gap in its directory
+        entries, which is filled by the next new entry, breaking play order.
+        """
+        jobs = collections.OrderedDict()  # Source -> [size, [(destination, path written), ...]]
+        renames = []  # Per batch: list of (temporary path, destination)
+        kinds = set()
+        for n, batch in batches:
+            plc, journal, actions, done = runs[n]
+            renames.append([])
+            staging_path = os.path.join(plc.destination, STAGING_NAME)
+            os.makedirs(staging_path, exist_ok=True)
+            for k in batch:
+                kind, src_path, path, size = actions[k]
+                dst_path = os.path.join(plc.destination, path)
+                part_path = os.path.join(staging_path, '%s-%d%s' % (INTERNAL_PREFIX, k, PART_SUFFIX))
+                # Renamed before interruption (an update is always copied again)
+                if resumed and kind == 'copy' and not os.path.exists(part_path) and os.path.exists(dst_path):
+                    continue
+                # Source deleted or renamed since planning: left to the next run (planned again)
+                if resumed and src_path not in jobs and not os.path.isfile(src_path):
+                    self.logger.warning('Source %s is missing, not copied to %s', src_path, dst_path)
+                    try:
+                        os.unlink(part_path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                jobs.setdefault(src_path, [size, []])[1].append((dst_path, part_path))
+                renames[-1].append((part_path, dst_path))
+                kinds.add(kind)
+
+        if jobs:
+            if self.copier is None:
+                self.copier = FileCopier(self.logger, self.read_jobs, self.write_jobs, self.copy_backend,
+                                         self.buffer_size, self.preallocate, self.metrics, self.events)
+            copy_jobs = [(src_path, job[0], job[1]) for src_path, job in jobs.items()]
+            if self.read_order != 'playlist':
+                with self.metrics.phase('read_order'):
+                    copy_jobs.sort(key=self._read_order_key)
+            with self.metrics.phase('copy'):
+                self.copier.copy(copy_jobs, 'Updating' if kinds == {'update'} else 'Copying')
+            with self.metrics.phase('flush'):
+                sync_filesystems([runs[n][0].destination for n, batch in batches])
+            with self.metrics.phase('rename'):
+                for batch_renames in renames:
+                    for part_path, dst_path in batch_renames:
+                        os.replace(part_path, dst_path)
+                        self._emit('copied', path=dst_path)
+                    self.metrics.count('rename', len(batch_renames))
+        for n, batch in batches:
+            runs[n][1].checkpoint(positions[n])
+            self._emit('checkpoint', destination=runs[n][0].destination, done=positions[n], total=len(runs[n][2]))
+
+    def _read_order_key(self, job):
+        """ Sort key of a copy job for reading sources in physical order
+
+        inode: by device and inode (approximates the location on disk on most file systems),
+        directory: by source folder (files of a folder are mostly stored close together).
+        Temporary files are created in this order, their final names are still given in play order.
+        """
+        if self.read_order == 'directory':
+            return os.path.split(job[0])
+        try:
+            stat = os.stat(job[0])
+        except OSError:
+            return (float('inf'), 0)  # Fails while copying
+        self.metrics.count('stat')
+        return (stat.st_dev, stat.st_ino)
 
-            # Allocate tracks to folder
-            for i in range(remainder):
-                try:
-                    track = tracks_stack.popitem(False)
-                    mapping[track[0]] = folder_path
-                    if self.tracks_per_folder != 0:
-                        self.destination_folders[folder_count] += 1
-                except KeyError:
-                    break  # No more tracks left
+    def _prepare_copying_additions(self, additions):
+        """ Prepare copying: Check device limits, create folders and allocate files to folders (folder of tracks)
+        """
+        if self.tracks_per_folder == 0:
+            if self.max_entries:
+                self._check_capacity(len(additions), self._free_root_entries(),
+                                     '%d tracks in destination, max %d entries per folder'
+                                     % (len(self.destination_tracks), self.max_entries))
+            for track in additions.values():
+                track.folder = None  # Tracks are shared by all destinations
+            return
+
+        slots = self.tracks_per_folder
+        max_folders = []
+        if self.max_folders:
+            max_folders.append(self.max_folders)
+        if self.max_entries:
+            slots = min(slots, self.max_entries)
+            max_folders.append(len(self.destination_folders) + self._free_root_entries())
+        allocator = FolderAllocator(self.destination_folders, slots, min(max_folders) if max_folders else None,
+                                    self.placement)
+        free = allocator.free_slots()
+        if free is not None:
+            self._check_capacity(len(additions), free, '%d of max %d folders used, max %d tracks per folder, '
+                                 '%d tracks in destination' % (len(self.destination_folders), allocator.max_folders,
+                                                               slots, len(self.destination_tracks)))
+
+        numbers = allocator.allocate(len(additions))
+        for number in allocator.created:
+            folder_path = self._create_folder_path(number)
+            self.logger.info('Creating folder "%s"', folder_path)
+            self.actions.append(['mkdir', self._relative_path(folder_path)])
+        for track, number in zip(additions.values(), numbers):
+            track.folder = number
+
+    def _free_root_entries(self):
+        """ Count of entries which can be added to the root of destination (max entries)
+        """
+        root = self.destination_listing.get('', [None, [], []])
+        if self.tracks_per_folder == 0:
+            used = len(self.destination_tracks) + len(root[2])
+        else:
+            used = len(root[1]) + len(self.destination_folders)
+            used += sum(1 for f in root[2] if self._extract_folder_number(f) is None)
+        return max(self.max_entries - used, 0)
 
-        return mapping
+    def _check_capacity(self, count, free, report):
+        """ Fail before changing anything if destination can't take all new tracks (device limits)
+        """
+        if count > free:
+            raise IOError('Destination %s can\'t take %d new tracks, only %d free slots (%s)'
+                          % (self.destination, count, free, report))
 
     def _sync_deletions(self, deletions):
         """ Sync deletions: Delete files and delete empty folders
         """
-        for k, f in deletions.items():
-            self.logger.info('Deleting file %s' % f)
-            if not self.dry_run:
-                os.unlink(f)
-
-            # Keep file and folder lists in sync
-            self.destination_files.remove(f)
+        freed = 0
+        for k, track in deletions.items():
+            path = track.path
+            self.logger.info('Deleting file %s', path)
+            size = self._destination_size(track)
+            freed += size
+            self.actions.append(['unlink', self._relative_path(path), size])
+
+            # Keep folder list in sync
             if self.tracks_per_folder != 0:
-                folder_name = os.path.basename(os.path.dirname(f))
-                folder_number = self._extract_folder_number(folder_name)
-                self.destination_folders[folder_number] -= 1
+                self.destination_folders[track.folder] -= 1
+        if deletions:
+            self.logger.info('Deletions free %.1f MB', freed / 10**6)
+
+        # Keep file list in sync
+        self.destination_tracks = [t for k, t in enumerate(self.destination_tracks) if k not in deletions]
 
         # Delete empty folders
         if self.tracks_per_folder != 0:
-            for folder_number, file_count in self.destination_folders.items():
+            for folder_number, file_count in list(self.destination_folders.items()):
                 if file_count == 0:
                     folder_path = self._create_folder_path(folder_number)
-                    if not self.dry_run:
-                        os.rmdir(folder_path)
+                    self.actions.append(['rmdir', self._relative_path(folder_path)])
                     del self.destination_folders[folder_number]
-                    self.logger.info('Deleting folder %s' % folder_path)
+                    self.logger.info('Deleting folder %s', folder_path)
+
+    def _destination_size(self, track):
+        """ Size of a file in destination (0 if it vanished)
+        """
+        if track.size < 0:
+            try:
+                track.size = os.stat(track.path).st_size
+            except OSError:
+                return 0
+            self.metrics.count('stat')
+        return track.size
 
     def _extract_folder_number(self, folder):
-        """ Extract folder number from name
+        """ Extract folder number from name (None if name doesn't match format)
         """
-        try:
-            folder_name_format = self.folder_name.replace('%d', r'(\d+)')
-            return int(re.findall(r'^%s$' % folder_name_format, folder)[0])
-        except IndexError:
-            return None  # Folder name doesn't match format
+        if self.folder_pattern is None:
+            parts = re.split(r'%0?\d*d', self.folder_name, 1)
+            if len(parts) != 2:
+                raise ValueError('Format for folder names needs %%d: %s' % self.folder_name)
+            self.folder_pattern = re.compile(r'^%s(\d+)%s$' % (re.escape(parts[0]), re.escape(parts[1])))
+        match = self.folder_pattern.match(folder)
+        return int(match.group(1)) if match else None
 
     def _create_folder_path(self, folder_number):
         """ Create folder path based on format and folder number
@@ -304,144 +2202,356 @@ class PlaylistCopy:
 class PlaylistCopyReshuffle(PlaylistCopy):
     """ Reshuffle all files (randomly place in other folders)
     """
-    def __init__(self, destination, folder_name='Folder %d', verbose=False, dry_run=False):
+    def __init__(self, destination, folder_name='Folder %d', verbose=False, dry_run=False, use_manifest=True,
+                 fraction=1.0, metrics=None):
         super().__init__(destination, [], tracks_per_folder=1, folder_name=folder_name,
-                         verbose=verbose, dry_run=dry_run)
+                         verbose=verbose, dry_run=dry_run, use_manifest=use_manifest, metrics=metrics)
+        self.fraction = fraction  # Part of files which are displaced
 
     def _allocate_files(self):
         """ Determine where to place which file (use existing file count per folder)
+
+        The folders of the displaced files form the slots, which are shuffled and
+        assigned to these files again. Files landing in their own folder are not moved.
         """
-        stack = []
-        for file in self.destination_files:
-            skipped_folders = set()
-            while True:
-                # Randomly choose folder which is not full
-                random_folder_key = random.choice(list(self.destination_folders.keys()))
-                if self.destination_folders[random_folder_key] == 0:
-                    skipped_folders.add(random_folder_key)
-                    if len(skipped_folders) >= len(self.destination_folders):
-                        raise RuntimeError('All folders are full?')
-                else:
-                    self.destination_folders[random_folder_key] -= 1
-                    folder_path = self._create_folder_path(random_folder_key)
-                    new_path = os.path.join(folder_path, os.path.basename(file))
-                    if file != new_path and os.path.isfile(new_path):
-                        raise FileExistsError('File %s does already exist. Are file names unique? '
-                                              '(rewrite-filenames)' % new_path)
-                    stack.append((file, new_path))
-                    break
+        tracks = self.destination_tracks
+        if self.fraction >= 1:
+            displaced = list(range(len(tracks)))
+        else:
+            displaced = random.sample(range(len(tracks)), round(len(tracks) * self.fraction))
+        slots = [(tracks[k].directory, tracks[k].folder) for k in displaced]
+        random.shuffle(slots)
+
+        moved = set()
+        stack = []  # (track, (new directory, new folder number))
+        for k, slot in zip(displaced, slots):
+            if tracks[k].directory != slot[0]:
+                moved.add(k)
+                stack.append((tracks[k], slot))
+        # Folders and keys of all files staying in their folder (for case-insensitive file systems)
+        occupied = set((track.directory, track.key) for k, track in enumerate(tracks) if k not in moved)
+        for track, slot in stack:
+            if (slot[0], track.key) in occupied:
+                raise FileExistsError('File %s does already exist. Are file names unique? '
+                                      '(rewrite-filenames)' % os.path.join(slot[0], track.basename))
+            occupied.add((slot[0], track.key))
         return stack
 
     def run(self):
         """ Move files
+
+        Files are moved in two phases (first to temporary names in the new folder),
+        so moves never collide with files which are moved later. The moves are
+        journaled like a sync, an interrupted reshuffle is finished by the next run.
+        """
+        if self.dry_run:
+            self.logger.warning('%s: PERFORMING DRY RUN', self.__class__.__name__)
+        else:
+            self._resume_journal()
+        with self.metrics.phase('reshuffle_scan'):
+            self._build_destination_file_list()
+        with self.metrics.phase('reshuffle_allocate'):
+            stack = self._allocate_files()
+        self.logger.warning('%d of %d files are moved', len(stack), len(self.destination_tracks))
+
+        temp_moves = []
+        final_moves = []
+        for k, (track, slot) in enumerate(stack):
+            new_path = os.path.join(slot[0], track.basename)
+            temp_path = os.path.join(slot[0], '%s-reshuffle-%d.tmp' % (INTERNAL_PREFIX, k))
+            self.logger.info('Moving file %s -> %s (%.2f%%)', track.path, new_path, (k + 1) / len(stack) * 100)
+            temp_moves.append(['move', self._relative_path(track.path), self._relative_path(temp_path)])
+            final_moves.append(['move', self._relative_path(temp_path), self._relative_path(new_path)])
+            track.directory, track.folder = slot  # Keep file list in sync
+        if self.dry_run:
+            return
+
+        if stack:
+            with self.metrics.phase('reshuffle_move'):
+                actions = temp_moves + final_moves
+                journal = Journal(os.path.join(self.destination, JOURNAL_NAME))
+                journal.create(actions)
+                self._apply_actions([(self, journal, actions, 0)])
+        with self.metrics.phase('write_manifest'):
+            self._write_manifest()
+
+
+class PlaylistCopyApply(PlaylistCopy):
+    """ Apply a SyncPlan (e.g. planned on another machine), journaled like a sync
+    """
+    def __init__(self, plan, **kwargs):
+        destinations = [destination['destination'] for destination in plan.destinations]
+        super().__init__(destinations[0] if destinations else '', [], **kwargs)
+        self.plan = plan
+
+    def run(self):
+        """ Apply actions of all destinations of the plan
+
+        An interrupted sync is finished first. If it was this plan, it's done then.
         """
         if self.dry_run:
-            self.logger.warning('%s: PERFORMING DRY RUN' % self.__class__.__name__)
-        self._build_destination_file_list()
-        stack = self._allocate_files()
-        files_done = 0
-        for entry in stack:
-            files_done += 1
-            percent = files_done / len(stack) * 100
-            self.logger.info('Moving file %s -> %s (%.2f%%)' % (entry[0], entry[1], percent))
-            if not self.dry_run:
-                shutil.move(entry[0], entry[1])
+            self.logger.warning('%s: PERFORMING DRY RUN', self.__class__.__name__)
+        self.targets = [self] + [self._create_target(destination['destination'])
+                                 for destination in self.plan.destinations[1:]]
+        runs = []
+        for plc, destination in zip(self.targets, self.plan.destinations):
+            actions = destination['actions']
+            self.logger.warning('%s: %d additions, %d deletions, %d updates (%.1f MB, %.1f MB freed)',
+                                plc.destination, destination['additions'], destination['deletions'],
+                                destination['updates'], destination['bytes'] / 10**6,
+                                destination.get('freed', 0) / 10**6)
+            if self.dry_run:
+                for action in actions:
+                    self.logger.info('%s %s', action[0], ' -> '.join(str(value) for value in action[1:3]))
+            elif actions and plc._resume_journal() != actions:
+                journal = Journal(os.path.join(plc.destination, JOURNAL_NAME))
+                journal.create(actions)
+                runs.append((plc, journal, actions, 0))
+        if runs:
+            self._apply_actions(runs)
+
+
+class PlaylistCopyWatch(PlaylistCopy):
+    """ Sync, then watch playlists and source tracks (inotify) and sync changes
+
+    Tracks of playlists, tags and destination files are kept in memory: after a change
+    only changed playlists are parsed, only changed tracks are read and the destination
+    isn't scanned again (it must not be changed by others meanwhile).
+    """
+    def __init__(self, destination, playlists, debounce=2.0, **kwargs):
+        super().__init__(destination, playlists, mode='sync', **kwargs)
+        self.debounce = debounce  # Seconds without further changes before syncing
+        self.playlist_paths = {}  # Playlist -> full paths of its tracks
+        self.tags = {}  # Path -> tags (or exception if unreadable)
+        self.inotify = None
+
+    def _playlist_paths(self, file):
+        """ Full paths of all local tracks of a playlist (parsed again only after a change)
+        """
+        if file not in self.playlist_paths:
+            self.playlist_paths[file] = list(super()._playlist_paths(file))
+        return self.playlist_paths[file]
+
+    def run(self):
+        """ Sync, then sync again after each change until interrupted (Ctrl+C)
+        """
+        self.inotify = Inotify()
+        try:
+            for playlist in self.playlists:
+                self.inotify.add_watch(os.path.dirname(os.path.realpath(playlist)))
+            super().run()
+            self._watch_sources()
+
+            rescan = False
+            while True:
+                self.logger.warning('Watching %d playlists and %d source folders for changes',
+                                    len(self.playlists), len(self.inotify.watches))
+                while not self._changed(self._wait_for_changes()):
+                    pass
+                try:
+                    if rescan:
+                        for plc in self.targets:
+                            plc._reset_destination()
+                            if not self.dry_run:
+                                plc._resume_journal()
+                    self._run_sync(scan=rescan)
+                    rescan = False
+                except (OSError, AssertionError) as e:
+                    self.logger.error('Sync failed, retrying after next change (%s)', e)
+                    rescan = True  # Destination may be partly synced
+                self._watch_sources()
+        except KeyboardInterrupt:
+            self.logger.warning('Watching stopped')  # An interrupted sync is resumed by the next run
+        finally:
+            self.inotify.close()
+            self.inotify = None
+
+    def _watch_sources(self):
+        """ Watch all folders of source tracks (new ones after a sync)
+        """
+        for directory in self.source_directories:
+            try:
+                self.inotify.add_watch(directory)
+            except FileNotFoundError:
+                pass  # Tracks of missing folders can't be synced anyway
+            except OSError as e:
+                self.logger.warning('Folder %s isn\'t watched (%s)', directory, e)
+
+    def _wait_for_changes(self):
+        """ Wait for events until there is no further event for debounce seconds
+        """
+        events = self.inotify.read()
+        while True:
+            more = self.inotify.read(self.debounce)
+            if not more:
+                return events
+            events.extend(more)
+
+    def _read_tags(self):
+        """ Tags of all tracks, only read for new and changed tracks
+        """
+        missing = [track.path for track in self.tracks if track.path not in self.tags]
+        all_tags = read_tags_many(missing, self.jobs, self.tag_cache, self.metrics, self.tag_reader)
+        for path, tags in zip(missing, all_tags):
+            self.tags[path] = tags
+        return [self.tags[track.path] for track in self.tracks]
+
+    def _changed(self, events):
+        """ Drop cached data of changed playlists, folders and tracks, returns if a sync is needed
+        """
+        playlists = {os.path.realpath(playlist): playlist for playlist in self.playlists}
+        changed = False
+        for directory, name, mask in events:
+            if mask & IN_Q_OVERFLOW:  # Events lost: forget everything
+                self.playlist_paths.clear()
+                self.source_directories.clear()
+                self.source_stats.clear()
+                self.tags.clear()
+                return True
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if path in playlists:
+                self.logger.info('Playlist changed: %s', path)
+                self.playlist_paths.pop(playlists[path], None)
+                changed = True
+            if directory in self.source_directories:
+                del self.source_directories[directory]  # Listed again on next sync
+            if name and name in self.playlists_files_seen.get(directory, ()):
+                self.logger.info('Track changed: %s', path)
+                self.source_stats.pop(path, None)
+                self.tags.pop(path, None)
+                changed = True
+        return changed
 
 
 class PlaylistCopyStats():
     """ Build stats for tracks in destination
+
+    Tracks are stored column by column (one list per tag, strings interned).
     """
-    def __init__(self, destination, group_by='artist'):
+    COLUMNS = ('artist', 'album', 'title', 'genre', 'year')
+    GROUPS = ('artist', 'album', 'genre', 'year', 'track')
+    UNKNOWN = {'artist': 'Unknown artist', 'album': '_', 'title': 'Unknown track', 'genre': 'Unknown genre',
+               'year': 'Unknown year'}
+
+    def __init__(self, destination, group_by='artist', tag_cache=None, jobs=1, output_format='text',
+                 metrics=None, tag_reader='auto'):
         self.destination = destination
+        self.metrics = metrics if metrics is not None else Metrics()
         self.group_by = group_by
-        self.tracks = {}
+        self.tag_cache_path = tag_cache  # None = no tag cache
+        self.tag_reader = tag_reader
+        self.jobs = jobs
+        self.output_format = output_format
+        self.tracks = {column: [] for column in self.COLUMNS}
 
     def _get_tracks(self):
-        """ Walk through all files and folders
-        """
-        from hsaudiotag import auto  # hsaudiotag3k
-        for root, dirs, files in os.walk(self.destination):
-            for file in files:
-                path = os.path.join(root, file)
-                tags = auto.File(path)
-                if not tags.valid:
-                    #print(path)
-                    continue
-
-                artist = tags.artist.strip()
-                if not artist:
-                    artist = 'Unknown artist'
-                album = tags.album.strip()
-                if not album:
-                    album = '_'
-                title = tags.title.strip()
-                if not title:
-                    title = 'Unknown track'
-
-                if artist not in self.tracks:
-                    self.tracks[artist] = {}
-                if album not in self.tracks[artist]:
-                    self.tracks[artist][album] = []
-
-                self.tracks[artist][album].append(title)
+        """ Scan all files and folders and read their tags
+        """
+        tag_cache = TagCache(self.tag_cache_path) if self.tag_cache_path is not None else None
+        try:
+            with self.metrics.phase('scan'):
+                paths = self._scan_files()
+            with self.metrics.phase('read_tags'):
+                all_tags = read_tags_many(paths, self.jobs, tag_cache, self.metrics, self.tag_reader)
+        finally:
+            if tag_cache is not None:
+                self.metrics.add_tag_cache(tag_cache)
+                tag_cache.close()
+
+        for tags in all_tags:
+            if isinstance(tags, Exception) or not tags.valid:
+                continue
+            for column in self.COLUMNS:
+                value = str(getattr(tags, column)).strip()
+                self.tracks[column].append(sys.intern(value or self.UNKNOWN[column]))
+
+    def _scan_files(self):
+        """ List all files in destination and its sub directories (without files of playlistcopy)
+        """
+        paths = []
+        directories = [self.destination]
+        while directories:
+            self.metrics.count('scandir')
+            with os.scandir(directories.pop()) as it:
+                for entry in it:
+                    if entry.name.startswith(INTERNAL_PREFIX):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        paths.append(entry.path)
+        return paths
 
     def get_track_count(self):
         """ Complete track count
         """
-        track_count = 0
-        for artist, albums in self.tracks.items():
-            for album, tracks in albums.items():
-                track_count += len(tracks)
-        return track_count
+        return len(self.tracks['title'])
+
+    def count_by(self, key):
+        """ Track count per artist, album, genre, year or track (in one pass)
+        """
+        if key == 'track':  # Title: artist, album, track title
+            values = ('%s - %s - %s' % track for track in zip(self.tracks['artist'], self.tracks['album'],
+                                                                self.tracks['title']))
+        elif key == 'album':
+            values = ('%s - %s' % album for album in zip(self.tracks['artist'], self.tracks['album']))
+        else:
+            values = self.tracks[key]
+        return collections.Counter(values)
 
     def group_by_artist(self):
         """ Sum by artists
         """
-        artist_track_count = {}
-        for artist, albums in self.tracks.items():
-            for album, tracks in albums.items():
-                if artist not in artist_track_count:
-                    artist_track_count[artist] = 0
-                artist_track_count[artist] += len(tracks)
-        return artist_track_count
+        return dict(self.count_by('artist'))
 
     def group_by_title(self):
         """ Sum by tracks (title: artist, album, track title)
         """
-        track_count = {}
-        for artist, albums in self.tracks.items():
-            for album, tracks in albums.items():
-                for track in tracks:
-                    title = '%s - %s - %s' % (artist, album, track)
-                    if title not in track_count:
-                        track_count[title] = 0
-                    track_count[title] += 1
-        return track_count
+        return dict(self.count_by('track'))
+
+    def get_groups(self):
+        """ Groups to show: (name, track count, percentage)
+
+        By track only tracks which are several times in destination (sorted by count),
+        otherwise all groups sorted by name.
+        """
+        all_tracks = self.get_track_count()
+        counts = self.count_by(self.group_by)
+        if self.group_by == 'track':
+            names = [name for name in sorted(counts, key=counts.get) if counts[name] > 1]
+        else:
+            names = sorted(counts)
+        return [(name, counts[name], counts[name] / all_tracks * 100) for name in names]
 
     def print_stats(self):
-        """ Print stats (to console)
+        """ Print stats (to console) as text, JSON or CSV
         """
+        if self.group_by not in self.GROUPS:
+            raise NotImplementedError()
         self._get_tracks()
         all_tracks = self.get_track_count()
-
-        print('Tracks total: %d\n' % all_tracks)
-
-        if self.group_by == 'artist':
-            artist_track_count = self.group_by_artist()
-            keys = list(artist_track_count.keys())
-            keys.sort()
-            for k in keys:
-                percent = artist_track_count[k] / all_tracks * 100
-                print('%s: %s (%.2f%%)' % (k, artist_track_count[k], percent))
-        elif self.group_by == 'track':
-            track_count = self.group_by_title()
-            for track in sorted(track_count, key=track_count.get):
-                if track_count[track] == 1:
-                    continue
-                percent = track_count[track] / all_tracks * 100
-                print('%dx %s (%.2f%%)' % (track_count[track], track, percent))
+        with self.metrics.phase('group'):
+            groups = self.get_groups()
+
+        if self.output_format == 'json':
+            groups = [{'name': name, 'count': count, 'percent': round(percent, 2)} for name, count, percent in groups]
+            print(json.dumps({'tracks': all_tracks, 'group_by': self.group_by, 'groups': groups},
+                             ensure_ascii=False, indent=2))
+        elif self.output_format == 'csv':
+            import csv
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['name', 'count', 'percent'])
+            for name, count, percent in groups:
+                writer.writerow([name, count, '%.2f' % percent])
         else:
-            raise NotImplementedError()
+            print('Tracks total: %d\n' % all_tracks)
+            for name, count, percent in groups:
+                if self.group_by == 'track':
+                    print('%dx %s (%.2f%%)' % (count, name, percent))
+                else:
+                    print('%s: %s (%.2f%%)' % (name, count, percent))
 
 
 class ArgumentParser():
@@ -455,49 +2565,214 @@ class ArgumentParser():
         self._add_parser('append')
         self._add_parser('reshuffle')
         self._add_parser('stats')
+        self._add_parser('watch')
+        self._add_parser('plan')
+        self._add_parser('apply')
 
     def parse_args(self):
         args = self.parser.parse_args()
-        if args.task in ('sync', 'append'):
-            plc = PlaylistCopy(args.destination, args.playlists, args.task,
-                               rewrite_file_names=not args.no_rewrite_filenames,
-                               tracks_per_folder=args.tracks_per_folder, shuffle=args.shuffle,
-                               reshuffle=args.reshuffle, folder_name=args.folder_names,
-                               verbose=args.verbose, dry_run=args.dry_run)
+        if args.task is None:
+            self.parser.print_help()
+            return
+
+        metrics = Metrics()
+        try:
+            if args.profile:
+                import cProfile
+                import pstats
+                profile = cProfile.Profile()
+                try:
+                    profile.runcall(self._run_task, args, metrics)
+                finally:
+                    stats = pstats.Stats(profile, stream=sys.stderr)
+                    stats.sort_stats('cumulative').print_stats(30)
+            else:
+                self._run_task(args, metrics)
+        finally:
+            if args.metrics is not None:
+                metrics.write(args.metrics)
+
+    def _run_task(self, args, metrics):
+        """ Run selected task
+        """
+        if args.task in ('sync', 'append', 'watch', 'plan'):
+            options = dict(rewrite_file_names=not args.no_rewrite_filenames,
+                           tracks_per_folder=args.tracks_per_folder, shuffle=args.shuffle,
+                           folder_name=args.folder_names,
+                           verbose=args.verbose, dry_run=args.dry_run, tag_cache=self._tag_cache(args),
+                           jobs=args.jobs, use_manifest=not args.rescan, verify=args.verify,
+                           read_jobs=args.read_jobs, write_jobs=args.write_jobs,
+                           copy_backend=args.copy_backend, buffer_size=args.buffer_size * 1024,
+                           preallocate=not args.no_preallocate, metrics=metrics, also=args.also or (),
+                           tag_reader=args.tag_reader, placement=args.placement, max_folders=args.max_folders,
+                           max_entries=args.max_entries, max_name_length=args.max_name_length,
+                           read_order=args.read_order, entry_order=args.entry_order)
+            if args.task == 'watch':
+                plc = PlaylistCopyWatch(args.destination, args.playlists, debounce=args.debounce, **options)
+            elif args.task == 'plan':
+                plc = PlaylistCopy(args.destination, args.playlists, 'append' if args.append else 'sync', **options)
+                plc.plan().save(args.output)
+                return
+            else:
+                plc = PlaylistCopy(args.destination, args.playlists, args.task, reshuffle=args.reshuffle,
+                                   reshuffle_fraction=args.fraction, **options)
             plc.run()
+        elif args.task == 'apply':
+            plca = PlaylistCopyApply(SyncPlan.load(args.plan), verbose=args.verbose, dry_run=args.dry_run,
+                                     read_jobs=args.read_jobs, write_jobs=args.write_jobs,
+                                     copy_backend=args.copy_backend, buffer_size=args.buffer_size * 1024,
+                                     preallocate=not args.no_preallocate, metrics=metrics,
+                                     read_order=args.read_order)
+            plca.run()
         elif args.task == 'reshuffle':
             plcrs = PlaylistCopyReshuffle(args.destination, folder_name=args.folder_names,
-                                          verbose=args.verbose, dry_run=args.dry_run)
+                                          verbose=args.verbose, dry_run=args.dry_run, use_manifest=not args.rescan,
+                                          fraction=args.fraction, metrics=metrics)
             plcrs.run()
         elif args.task == 'stats':
-            plcs = PlaylistCopyStats(args.destination, group_by=args.group_by)
+            plcs = PlaylistCopyStats(args.destination, group_by=args.group_by, tag_cache=self._tag_cache(args),
+                                     jobs=args.jobs, output_format=args.format, metrics=metrics,
+                                     tag_reader=args.tag_reader)
             plcs.print_stats()
-        if args.task is None:
-            self.parser.print_help()
+
+    @staticmethod
+    def _fraction(value):
+        """ Argument type for fractions (0 to 1)
+        """
+        fraction = float(value)
+        if not 0 <= fraction <= 1:
+            raise argparse.ArgumentTypeError('%s is not between 0 and 1' % value)
+        return fraction
+
+    @staticmethod
+    def _destination(value):
+        """ Argument type for further destinations: PATH[,tracks-per-folder=N][,folder-names=FORMAT]
+        [,max-folders=N][,max-entries=N]
+        """
+        keys = ('tracks-per-folder', 'folder-names', 'max-folders', 'max-entries')
+        path, *options = re.split(r',(?=(?:%s)=)' % '|'.join(keys), value)
+        values = dict.fromkeys(keys)
+        for option in options:
+            key, option_value = option.split('=', 1)
+            if key != 'folder-names':
+                try:
+                    option_value = int(option_value)
+                except ValueError:
+                    raise argparse.ArgumentTypeError('invalid %s: %s' % (key, option_value))
+            values[key] = option_value
+        return (path,) + tuple(values[key] for key in keys)
+
+    @staticmethod
+    def _tag_cache(args):
+        """ Path to tag cache or None if disabled
+        """
+        if args.no_tag_cache:
+            return None
+        return args.tag_cache if args.tag_cache is not None else default_tag_cache_path()
+
+    @staticmethod
+    def _add_copy_arguments(parser):
+        parser.add_argument('--read-jobs', default=1, type=int,
+                            help='number of source files read in parallel while copying (default %(default)s)')
+        parser.add_argument('--write-jobs', default=1, type=int,
+                            help='number of destination files written in parallel (default %(default)s)')
+        parser.add_argument('--copy-backend', choices=COPY_BACKENDS, default='auto',
+                            help='how to copy files (default: %(default)s, first one supported of '
+                                 'copy_file_range, sendfile and buffered)')
+        parser.add_argument('--read-order', choices=READ_ORDERS, default='playlist',
+                            help='order of reading source files: playlist, inode or directory (less seeking '
+                                 'on hard disks, default: %(default)s)')
+        parser.add_argument('--buffer-size', default=COPY_BUFFER_SIZE // 1024, type=int, metavar='KIB',
+                            help='size of copied chunks in KiB (default %(default)s)')
+        parser.add_argument('--no-preallocate', action='store_true',
+                            help='don\'t preallocate destination files')
 
     def _add_parser(self, name):
         parser = self.subparsers.add_parser(name)
-        parser.add_argument('destination', help='path to destination (e.g. usb storage)')
-        if name in ('sync', 'append', 'reshuffle'):
+        if name == 'apply':
+            parser.add_argument('plan', help='path to plan (written by plan, - = stdin)')
             parser.add_argument('--dry-run', '-n', action='store_true',
-                                help='only make a trial run (no copying and deletion)')
+                                help='only show the actions of the plan (no copying and deletion)')
+            self._add_copy_arguments(parser)
+        else:
+            parser.add_argument('destination', help='path to destination (e.g. usb storage)')
+        if name in ('sync', 'append', 'reshuffle', 'watch', 'plan'):
+            if name != 'plan':
+                parser.add_argument('--dry-run', '-n', action='store_true',
+                                    help='only make a trial run (no copying and deletion)')
             parser.add_argument('--folder-names', default='Folder %d',
                                 help='format for folder names (for tracks-per-folder, default: "%(default)s")')
-            if name in ('sync', 'append'):
+            if name not in ('watch', 'plan'):
+                parser.add_argument('--fraction', default=1.0, type=self._fraction,
+                                    help='fraction of tracks moved on reshuffle (0 to 1, default %(default)s)')
+            parser.add_argument('--rescan', action='store_true',
+                                help='ignore manifest of last run and rescan all folders of destination')
+            if name in ('sync', 'append', 'watch', 'plan'):
                 parser.add_argument('--no-rewrite-filenames', action='store_true',
                                     help='don\'t rewrite filenames (no use of file tags)')
                 parser.add_argument('--shuffle', action='store_true',
                                     help='shuffle tracks in destination (only new tracks, for tracks-per-folder)')
-                parser.add_argument('--reshuffle', action='store_true', help='reshuffle all tracks in destination')
+                if name == 'watch':
+                    parser.add_argument('--debounce', default=2.0, type=float, metavar='SECONDS',
+                                        help='wait for further changes before syncing (default %(default)s)')
+                elif name == 'plan':
+                    parser.add_argument('--append', action='store_true',
+                                        help='plan an append instead of a sync (no deletions)')
+                    parser.add_argument('--output', '-o', default='-', metavar='PLAN',
+                                        help='path to write the plan to (JSON, default: stdout)')
+                    parser.set_defaults(dry_run=False)  # Planning doesn't change destination anyway
+                else:
+                    parser.add_argument('--reshuffle', action='store_true',
+                                        help='reshuffle all tracks in destination')
+                parser.add_argument('--verify', choices=['name', 'size', 'hash'], default='name',
+                                    help='detect changed tracks by name only, by size or by size and content hash '
+                                         '(default: %(default)s)')
+                parser.add_argument('--jobs', '-j', default=1, type=int,
+                                    help='number of files to read tags from in parallel (default %(default)s)')
+                self._add_copy_arguments(parser)
+                parser.add_argument('--entry-order', choices=ENTRY_ORDERS, default='append',
+                                    help='order of directory entries: append new files in play order or rewrite all '
+                                         'entries of changed folders in play order (FAT, default: %(default)s)')
                 parser.add_argument('--tracks-per-folder', default=0, type=int,
                                     help='maximum track count per folder (default 0, 0 = single folder)')
+                parser.add_argument('--placement', choices=FolderAllocator.PLACEMENTS, default='fill',
+                                    help='placement of new tracks in folders: fill folders one after another or '
+                                         'balanced track count per folder (default: %(default)s)')
+                parser.add_argument('--max-folders', default=0, type=int, metavar='N',
+                                    help='maximum folder count of device (default 0, 0 = unlimited)')
+                parser.add_argument('--max-entries', default=0, type=int, metavar='N',
+                                    help='maximum entries per folder of device (default 0, 0 = unlimited)')
+                parser.add_argument('--max-name-length', default=0, type=int, metavar='N',
+                                    help='maximum length of file names, longer ones are shortened '
+                                         '(default 0, 0 = unlimited)')
+                parser.add_argument('--also', action='append', type=self._destination,
+                                    metavar='PATH[,tracks-per-folder=N][,folder-names=FORMAT][,max-folders=N]'
+                                            '[,max-entries=N]',
+                                    help='sync a further destination at once (tracks and tags are read once, '
+                                         'repeatable; without options the ones of destination are used)')
                 parser.add_argument('playlists', metavar='playlist', nargs='+',
-                                    help='path to playlist files, multiple playlists possible (m3u)')
+                                    help='path to playlist files, multiple playlists possible (m3u, m3u8, pls, xspf)')
+        if name in ('sync', 'append', 'stats', 'watch', 'plan'):
+            parser.add_argument('--tag-cache', metavar='PATH',
+                                help='path to tag cache (default: %s)' % default_tag_cache_path())
+            parser.add_argument('--no-tag-cache', action='store_true',
+                                help='don\'t use the tag cache (parse tags of all files)')
+            parser.add_argument('--tag-reader', choices=['auto'] + list(TAG_READERS), default='auto',
+                                help='how to read tags (default: %(default)s, native for MP3, FLAC and MP4, '
+                                     'hsaudiotag for all other formats)')
         if name == 'stats':
-            parser.add_argument('--group-by', type=str, choices=['artist', 'track'], default='artist',
-                                help='only make a trial run (no copying and deletion)')
+            parser.add_argument('--group-by', type=str, choices=PlaylistCopyStats.GROUPS, default='artist',
+                                help='group tracks by artist, album, genre, year or track (default: %(default)s)')
+            parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text',
+                                help='output format (default: %(default)s)')
+            parser.add_argument('--jobs', '-j', default=1, type=int,
+                                help='number of files to read tags from in parallel (default %(default)s)')
         parser.add_argument('-v', '--verbose', action='store_true',
                             help='show output for all track actions')
+        parser.add_argument('--metrics', metavar='FILE',
+                            help='write time per phase and counters (stat, open, bytes, cache hits) as JSON')
+        parser.add_argument('--profile', action='store_true',
+                            help='profile the run with cProfile (top functions printed to stderr)')
 
 
 def main():
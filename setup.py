@@ -25,6 +25,7 @@ setup(
         'Topic :: Multimedia :: Sound/Audio :: Analysis',
         'Topic :: Multimedia :: Sound/Audio :: CD Audio :: CD Playing',
     ],
+    python_requires='>=3.7',
     install_requires=[
         'chardet',
         'hsaudiotag3k'
@@ -0,0 +1,59 @@
+import collections
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import playlistcopy  # noqa: E402
+
+
+class FolderAllocatorTest(unittest.TestCase):
+    def _allocator(self, folders, slots=10, max_folders=None, placement='fill'):
+        return playlistcopy.FolderAllocator(collections.OrderedDict(folders), slots, max_folders, placement)
+
+    def test_fill_lowest_folder_first(self):
+        allocator = self._allocator({1: 10, 3: 8})
+        self.assertEqual(allocator.allocate(5), [2, 2, 2, 2, 2])
+        self.assertEqual(allocator.created, [2])
+
+    def test_fill_skips_full_folders(self):
+        allocator = self._allocator({1: 10, 2: 10, 3: 8})
+        self.assertEqual(allocator.allocate(4), [3, 3, 4, 4])
+        self.assertEqual(allocator.folders, {1: 10, 2: 10, 3: 10, 4: 2})
+        self.assertEqual(allocator.created, [4])
+
+    def test_fill_respects_max_folders_with_gap(self):
+        allocator = self._allocator({1: 10, 3: 5}, max_folders=2)
+        self.assertEqual(allocator.free_slots(), 5)
+        self.assertEqual(allocator.allocate(5), [3] * 5)
+        self.assertEqual(allocator.created, [])
+        self.assertEqual(len(allocator.folders), 2)
+
+    def test_free_slots(self):
+        self.assertIsNone(self._allocator({1: 3}).free_slots())
+        self.assertEqual(self._allocator({1: 3}, max_folders=3).free_slots(), 7 + 2 * 10)
+        self.assertEqual(self._allocator({1: 10, 2: 10, 3: 10}, max_folders=2).free_slots(), 0)
+
+    def test_allocate_up_to_free_slots(self):
+        for placement in playlistcopy.FolderAllocator.PLACEMENTS:
+            allocator = self._allocator({2: 4, 5: 9}, max_folders=3, placement=placement)
+            count = allocator.free_slots()
+            numbers = allocator.allocate(count)
+            self.assertEqual(len(numbers), count)
+            self.assertLessEqual(len(allocator.folders), 3)
+            self.assertTrue(all(tracks == 10 for tracks in allocator.folders.values()))
+
+    def test_balanced(self):
+        allocator = self._allocator({1: 6}, placement='balanced')
+        numbers = allocator.allocate(8)
+        self.assertEqual(allocator.folders, {1: 7, 2: 7})
+        self.assertEqual(collections.Counter(numbers), {1: 1, 2: 7})
+
+    def test_balanced_respects_max_folders(self):
+        allocator = self._allocator({1: 2}, slots=5, max_folders=2, placement='balanced')
+        allocator.allocate(8)
+        self.assertEqual(allocator.folders, {1: 5, 2: 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import playlistcopy  # noqa: E402
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, playlistcopy.JOURNAL_NAME)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_create_and_load(self):
+        actions = [['mkdir', 'Folder 1'], ['copy', '/music/ä.mp3', 'Folder 1/ä.mp3', 10]]
+        journal = playlistcopy.Journal(self.path)
+        journal.create(actions)
+        journal.checkpoint(1)
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+        journal.create(actions)
+        journal.checkpoint(1)
+        journal.checkpoint(2)
+        journal.file.close()
+        journal = playlistcopy.Journal(self.path)
+        self.assertEqual(journal.load(), (actions, 2))
+        journal.remove()
+
+    def test_load_missing(self):
+        self.assertIsNone(playlistcopy.Journal(self.path).load())
+
+    def test_load_torn_checkpoint(self):
+        journal = playlistcopy.Journal(self.path)
+        journal.create([['rmdir', 'Folder 1'], ['rmdir', 'Folder 2']])
+        journal.checkpoint(1)
+        journal.file.write('{"do')  # Interrupted while writing
+        journal.file.close()
+        journal = playlistcopy.Journal(self.path)
+        self.assertEqual(journal.load()[1], 1)
+        journal.checkpoint(2)  # Starts on a new line
+        journal.file.close()
+        journal = playlistcopy.Journal(self.path)
+        self.assertEqual(journal.load()[1], 2)
+        journal.remove()
+
+    def test_unknown_version(self):
+        with open(self.path, 'w') as f:
+            f.write('{"version":0,"actions":[]}\n')
+        with self.assertRaises(ValueError):
+            playlistcopy.Journal(self.path).load()
+
+
+class ResumeJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tempdir.name, 'source')
+        self.destination = os.path.join(self.tempdir.name, 'destination')
+        os.mkdir(self.source)
+        os.mkdir(self.destination)
+        for name in ('a.mp3', 'b.mp3', 'c.mp3'):
+            self._write(os.path.join(self.source, name), name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _read(self, *names):
+        with open(os.path.join(self.destination, *names)) as f:
+            return f.read()
+
+    def test_resume_interrupted_sync(self):
+        actions = [['unlink', 'old.mp3', 3], ['mkdir', 'Folder 1']]
+        actions += [['copy', os.path.join(self.source, name), os.path.join('Folder 1', name), 5]
+                    for name in ('a.mp3', 'b.mp3', 'c.mp3')]
+        journal = playlistcopy.Journal(os.path.join(self.destination, playlistcopy.JOURNAL_NAME))
+        journal.create(actions)
+        journal.file.close()
+        # Interrupted while renaming the copies: a.mp3 is renamed, b.mp3 still a temporary file
+        os.mkdir(os.path.join(self.destination, 'Folder 1'))
+        self._write(os.path.join(self.destination, 'Folder 1', 'a.mp3'), 'renamed')
+        os.mkdir(os.path.join(self.destination, playlistcopy.STAGING_NAME))
+        self._write(os.path.join(self.destination, playlistcopy.STAGING_NAME, '.playlistcopy-3.part'), 'b.m')
+
+        plc = playlistcopy.PlaylistCopy(self.destination, [])
+        self.assertEqual(plc._resume_journal(), actions)
+        self.assertEqual(self._read('Folder 1', 'a.mp3'), 'renamed')  # Not copied again
+        self.assertEqual(self._read('Folder 1', 'b.mp3'), 'b.mp3')
+        self.assertEqual(self._read('Folder 1', 'c.mp3'), 'c.mp3')
+        self.assertEqual(os.listdir(self.destination), ['Folder 1'])
+        self.assertIsNone(plc._resume_journal())
+
+    def test_resume_with_missing_source(self):
+        actions = [['mkdir', 'Folder 1']]
+        actions += [['copy', os.path.join(self.source, name), os.path.join('Folder 1', name), 5]
+                    for name in ('a.mp3', 'b.mp3', 'c.mp3')]
+        journal = playlistcopy.Journal(os.path.join(self.destination, playlistcopy.JOURNAL_NAME))
+        journal.create(actions)
+        journal.file.close()
+        os.mkdir(os.path.join(self.destination, playlistcopy.STAGING_NAME))
+        self._write(os.path.join(self.destination, playlistcopy.STAGING_NAME, '.playlistcopy-2.part'), 'b.m')
+        os.unlink(os.path.join(self.source, 'b.mp3'))  # Deleted after interruption
+
+        plc = playlistcopy.PlaylistCopy(self.destination, [])
+        with self.assertLogs(plc.logger, 'WARNING'):
+            plc._resume_journal()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.destination, 'Folder 1'))), ['a.mp3', 'c.mp3'])
+        self.assertEqual(os.listdir(self.destination), ['Folder 1'])
+
+    def test_resume_moves(self):
+        os.mkdir(os.path.join(self.destination, 'Folder 1'))
+        os.mkdir(os.path.join(self.destination, 'Folder 2'))
+        self._write(os.path.join(self.destination, 'Folder 1', 'a.mp3'), 'a.mp3')
+        self._write(os.path.join(self.destination, 'Folder 2', 'b.mp3'), 'b.mp3')
+        actions = [['move', 'Folder 1/a.mp3', 'Folder 2/.playlistcopy-reshuffle-0.tmp'],
+                   ['move', 'Folder 2/b.mp3', 'Folder 1/.playlistcopy-reshuffle-1.tmp'],
+                   ['move', 'Folder 2/.playlistcopy-reshuffle-0.tmp', 'Folder 2/a.mp3'],
+                   ['move', 'Folder 1/.playlistcopy-reshuffle-1.tmp', 'Folder 1/b.mp3']]
+        journal = playlistcopy.Journal(os.path.join(self.destination, playlistcopy.JOURNAL_NAME))
+        journal.create(actions)
+        journal.file.close()
+        # Interrupted after the first move of a reshuffle
+        os.rename(os.path.join(self.destination, 'Folder 1', 'a.mp3'),
+                  os.path.join(self.destination, 'Folder 2', '.playlistcopy-reshuffle-0.tmp'))
+
+        playlistcopy.PlaylistCopy(self.destination, [])._resume_journal()
+        self.assertEqual(sorted(os.listdir(self.destination)), ['Folder 1', 'Folder 2'])
+        self.assertEqual(os.listdir(os.path.join(self.destination, 'Folder 1')), ['b.mp3'])
+        self.assertEqual(os.listdir(os.path.join(self.destination, 'Folder 2')), ['a.mp3'])
+        self.assertEqual(self._read('Folder 2', 'a.mp3'), 'a.mp3')
+
+
+if __name__ == '__main__':
+    unittest.main()
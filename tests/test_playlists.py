@@ -0,0 +1,45 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import playlistcopy  # noqa: E402
+
+
+class ReadPlaylistTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _playlist(self, name, content):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return list(playlistcopy.read_playlist(path))
+
+    def test_m3u(self):
+        locations = self._playlist('a.m3u8', '#EXTM3U\n#EXTINF:123,Artist - Title\n/music/ä b.mp3\n\n'
+                                             'http://radio.example.com/stream\nfile:///music/c%20d.mp3\n')
+        self.assertEqual(locations, ['/music/ä b.mp3', None, '/music/c d.mp3'])
+
+    def test_pls(self):
+        locations = self._playlist('a.pls', '[playlist]\nFile1=/music/a.mp3\nTitle1=A\n'
+                                            'File2=http://radio.example.com/stream\nFile3=file:///music/b.mp3\n'
+                                            'NumberOfEntries=3\nVersion=2\n')
+        self.assertEqual(locations, ['/music/a.mp3', None, '/music/b.mp3'])
+
+    def test_xspf(self):
+        locations = self._playlist('a.xspf', '<?xml version="1.0" encoding="UTF-8"?>\n'
+                                             '<playlist version="1" xmlns="http://xspf.org/ns/0/"><trackList>'
+                                             '<track><location>file:///music/%C3%A4%20b.mp3</location></track>'
+                                             '<track><location>http://radio.example.com/stream</location></track>'
+                                             '<track><location>/music/c%20d.mp3</location></track>'
+                                             '</trackList></playlist>\n')
+        self.assertEqual(locations, ['/music/ä b.mp3', None, '/music/c d.mp3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import playlistcopy  # noqa: E402
+
+
+def synchsafe(value):
+    return bytes((value >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+
+def id3v2(version, frames, flags=0, padding=0):
+    body = b''.join(frames) + b'\0' * padding
+    return b'ID3' + bytes((version, 0, flags)) + synchsafe(len(body)) + body
+
+
+def id3_frame(version, frame_id, text, encoding=3, flags=0):
+    data = bytes((encoding,)) + text.encode(playlistcopy.ID3_ENCODINGS[encoding])
+    if version == 2:
+        return frame_id + len(data).to_bytes(3, 'big') + data
+    size = synchsafe(len(data)) if version == 4 else len(data).to_bytes(4, 'big')
+    return frame_id + size + flags.to_bytes(2, 'big') + data
+
+
+def flac(*blocks):
+    data = b'fLaC'
+    for k, (kind, content) in enumerate(blocks):
+        last = 0x80 if k == len(blocks) - 1 else 0
+        data += bytes((last | kind,)) + len(content).to_bytes(3, 'big') + content
+    return data
+
+
+def vorbis_comment(*comments):
+    vendor = b'reference libFLAC'
+    data = len(vendor).to_bytes(4, 'little') + vendor + len(comments).to_bytes(4, 'little')
+    for comment in comments:
+        data += len(comment).to_bytes(4, 'little') + comment
+    return data
+
+
+def atom(kind, *children):
+    content = b''.join(children)
+    return (len(content) + 8).to_bytes(4, 'big') + kind + content
+
+
+def mp4_data(value):
+    return atom(b'data', b'\0\0\0\x01', b'\0\0\0\0', value)
+
+
+def mp4(*items, extra=b''):
+    ilst = atom(b'ilst', *(atom(kind, mp4_data(value)) for kind, value in items))
+    meta = atom(b'meta', b'\0\0\0\0', atom(b'hdlr', b'\0' * 25), ilst)
+    return atom(b'ftyp', b'M4A \0\0\0\0') + extra + atom(b'moov', atom(b'mvhd', b'\0' * 100),
+                                                        atom(b'udta', meta)) + atom(b'mdat', b'\0' * 64)
+
+
+class Id3v2Test(unittest.TestCase):
+    def test_version_3(self):
+        data = id3v2(3, [id3_frame(3, b'TPE1', 'Artist', 0), id3_frame(3, b'TALB', 'Album', 0),
+                         id3_frame(3, b'TIT2', 'Title', 1), id3_frame(3, b'TCON', '(17)', 0),
+                         id3_frame(3, b'TYER', '1999', 0)], padding=100)
+        self.assertEqual(playlistcopy._parse_id3v2(data),
+                         {'artist': 'Artist', 'album': 'Album', 'title': 'Title', 'genre': 'Rock', 'year': '1999'})
+
+    def test_version_4(self):
+        title = 'Tïtle ' * 40  # Frame size above 127 (synchsafe)
+        data = id3v2(4, [id3_frame(4, b'TIT2', title), id3_frame(4, b'TDRC', '2001-05-01'),
+                         id3_frame(4, b'TCON', 'Jazz\0Funk')])
+        self.assertEqual(playlistcopy._parse_id3v2(data), {'title': title, 'year': '2001-05-01', 'genre': 'Jazz'})
+
+    def test_version_2(self):
+        data = id3v2(2, [id3_frame(2, b'TT2', 'Title', 0), id3_frame(2, b'TP1', 'Artist', 0),
+                         id3_frame(2, b'TCO', '(8)', 0)])
+        self.assertEqual(playlistcopy._parse_id3v2(data), {'title': 'Title', 'artist': 'Artist', 'genre': 'Jazz'})
+
+    def test_genre_numbers(self):
+        for genre, expected in (('(17)', 'Rock'), ('(17)Rock', 'Rock'), ('8', 'Jazz'), ('80s Pop', '80s Pop'),
+                                ('2 Tone', '2 Tone'), ('(Live)', '(Live)')):
+            data = id3v2(3, [id3_frame(3, b'TCON', genre, 0)])
+            self.assertEqual(playlistcopy._parse_id3v2(data), {'genre': expected})
+
+    def test_first_frame_wins(self):
+        data = id3v2(3, [id3_frame(3, b'TIT2', 'First', 0), id3_frame(3, b'TIT2', 'Second', 0)])
+        self.assertEqual(playlistcopy._parse_id3v2(data), {'title': 'First'})
+
+    def test_skips_unknown_and_compressed_frames(self):
+        data = id3v2(3, [id3_frame(3, b'APIC', 'cover', 0), id3_frame(3, b'TALB', 'Packed', 0, flags=0x80),
+                         id3_frame(3, b'TPE1', 'Artist', 0)])
+        self.assertEqual(playlistcopy._parse_id3v2(data), {'artist': 'Artist'})
+
+    def test_truncated(self):
+        data = id3v2(3, [id3_frame(3, b'TPE1', 'Artist', 0), id3_frame(3, b'TIT2', 'Title', 0)])
+        self.assertEqual(playlistcopy._parse_id3v2(data[:-3]), {'artist': 'Artist'})
+
+    def test_extended_header(self):
+        extended = (6).to_bytes(4, 'big') + b'\0' * 6
+        frames = extended + id3_frame(3, b'TIT2', 'Title', 0)
+        data = b'ID3\x03\x00\x40' + synchsafe(len(frames)) + frames
+        self.assertEqual(playlistcopy._parse_id3v2(data), {'title': 'Title'})
+
+
+class FlacTest(unittest.TestCase):
+    def test_vorbis_comment(self):
+        data = flac((0, b'\0' * 34), (1, b'\0' * 16),
+                    (4, vorbis_comment(b'TITLE=Title', b'artist=Artist', b'DATE=2003', b'TITLE=Other')))
+        self.assertEqual(playlistcopy._read_flac(data), {'title': 'Title', 'artist': 'Artist', 'year': '2003'})
+
+    def test_without_vorbis_comment(self):
+        self.assertEqual(playlistcopy._read_flac(flac((0, b'\0' * 34))), {})
+
+    def test_corrupt_comment_count(self):
+        comment = vorbis_comment(b'TITLE=Title')
+        count = 4 + int.from_bytes(comment[:4], 'little')  # Behind vendor string
+        comment = comment[:count] + (0x10000000).to_bytes(4, 'little') + comment[count + 4:]
+        self.assertEqual(playlistcopy._read_flac(flac((4, comment))), {'title': 'Title'})
+
+    def test_truncated_comment(self):
+        self.assertEqual(playlistcopy._read_flac(flac((4, vorbis_comment(b'ARTIST=Artist', b'TITLE=Title')[:-3]))),
+                         {'artist': 'Artist'})
+
+    def test_stops_at_last_block(self):
+        data = flac((0, b'\0' * 34)) + flac((4, vorbis_comment(b'TITLE=Title')))[4:]
+        self.assertEqual(playlistcopy._read_flac(data), {})
+
+
+class Mp4Test(unittest.TestCase):
+    def test_ilst(self):
+        data = mp4((b'\xa9nam', b'Title'), (b'\xa9ART', b'Artist'), (b'\xa9day', b'2010'),
+                   (b'gnre', (9 + 1).to_bytes(2, 'big')))  # Genre number + 1
+        self.assertEqual(playlistcopy._read_mp4(data),
+                         {'title': 'Title', 'artist': 'Artist', 'year': '2010', 'genre': 'Metal'})
+
+    def test_64_bit_atom_size(self):
+        free = (1).to_bytes(4, 'big') + b'free' + (24).to_bytes(8, 'big') + b'\0' * 8
+        data = mp4((b'\xa9alb', 'Älbum'.encode('utf-8')), extra=free)
+        self.assertEqual(playlistcopy._read_mp4(data), {'album': 'Älbum'})
+
+    def test_without_metadata(self):
+        data = atom(b'ftyp', b'M4A \0\0\0\0') + atom(b'moov', atom(b'mvhd', b'\0' * 100))
+        self.assertEqual(playlistcopy._read_mp4(data), {})
+
+
+
+class TagCacheTest(unittest.TestCase):
+    def test_keyed_by_reader(self):
+        cache = playlistcopy.TagCache(':memory:')
+        stat = os.stat(__file__)
+        tags = playlistcopy.Tags(True, 'Artist', 'Album', 'Title', 'Rock', '1999')
+        cache.put(__file__, stat, tags, 'native')
+        self.assertEqual(cache.get(__file__, stat, 'native'), tags)
+        self.assertIsNone(cache.get(__file__, stat, 'hsaudiotag'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()